@@ -0,0 +1,162 @@
+"""
+Benchmarks match() on synthetic populations shaped like the general population
+cohorts (sex, age, STP and index date), so that changes to the matching engine
+can be checked at production scale.
+
+For each number of controls, a case and a control csv are generated and each
+scenario is run in a fresh process, so that peak memory is measured per run.
+Prints the run time, throughput (cases matched per second) and peak memory.
+
+Usage: python analysis/benchmark_matching.py [n_controls ...]
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+CASES_PER_CONTROL = 0.02
+N_STPS = 32
+YEAR = 2020
+MATCH_VARIABLES = {"sex": "category", "age": 1, "stp": "category"}
+SCENARIOS = {
+    "individual": dict(closest_match_variables=["age"]),
+    "individual_no_closest": dict(),
+    "individual_exclusions": dict(
+        closest_match_variables=["age"],
+        date_exclusion_variables={"died_date": "before"},
+        replace_match_index_date_with_case="no_offset",
+    ),
+    "individual_index_month": dict(
+        match_variables={"sex": "category", "patient_index_date": "month_only"},
+        closest_match_variables=["age"],
+    ),
+    "frequency": dict(matching_type="frequency"),
+    "frequency_streamed": dict(matching_type="frequency", stream_matches=True),
+}
+
+
+def synthetic_population(n: int, seed: int) -> pd.DataFrame:
+    """
+    n patients with a roughly even sex split, an adult age distribution that
+    thins out in old age, STPs of uneven size, an index date spread uniformly
+    over the year from February, and a died_date for about 2% of patients.
+    """
+    rng = np.random.default_rng(seed)
+    stp_shares = rng.dirichlet(np.full(N_STPS, 5.0))
+    ages = np.minimum(18 + rng.gamma(2.5, 16.0, n), 105).astype(np.int8)
+    start = np.datetime64(f"{YEAR}-02-01")
+    n_days = (np.datetime64(f"{YEAR}-12-31") - start).astype(int) + 1
+    died_date = start + rng.integers(-365, 2 * 365, n).astype("timedelta64[D]")
+    died_date[rng.random(n) >= 0.02] = np.datetime64("NaT")
+    return pd.DataFrame(
+        {
+            "sex": np.where(rng.random(n) < 0.51, "F", "M"),
+            "age": ages,
+            "stp": np.char.add(
+                "E540000", rng.choice(N_STPS, n, p=stp_shares).astype(str)
+            ),
+            "patient_index_date": start
+            + rng.integers(0, n_days, n).astype("timedelta64[D]"),
+            "died_date": died_date,
+        },
+        index=pd.RangeIndex(n, name="patient_id") + seed * 100_000_000,
+    )
+
+
+def write_populations(n_controls: int, data_path: str) -> int:
+    """
+    Writes cases.csv and controls.csv to data_path, and returns the number of
+    cases.
+    """
+    n_cases = max(int(n_controls * CASES_PER_CONTROL), 1)
+    synthetic_population(n_cases, seed=1).to_csv(os.path.join(data_path, "cases.csv"))
+    synthetic_population(n_controls, seed=2).to_csv(
+        os.path.join(data_path, "controls.csv")
+    )
+    return n_cases
+
+
+def run_scenario(scenario: str, data_path: str) -> None:
+    """
+    Runs one scenario on the csvs in data_path and prints its run time, number of
+    cases matched and peak memory as a line of JSON.
+    """
+    from osmatching_local import match, peak_rss_mb
+
+    output_path = os.path.join(data_path, scenario)
+    options = {"match_variables": MATCH_VARIABLES, **SCENARIOS[scenario]}
+    start = time.perf_counter()
+    match(
+        case_csv="cases.csv",
+        match_csv="controls.csv",
+        matches_per_case=5,
+        index_date_variable="patient_index_date",
+        input_path=data_path,
+        output_path=output_path,
+        output_tables=("cases", "matches"),
+        **options,
+    )
+    seconds = time.perf_counter() - start
+    n_matched = len(pd.read_csv(os.path.join(output_path, "matched_cases.csv")))
+    peak = peak_rss_mb()
+    print(
+        json.dumps(
+            {
+                "seconds": seconds,
+                "matched_cases": n_matched,
+                "peak_rss_mb": None if peak is None else max(peak.values()),
+            }
+        )
+    )
+
+
+def run_script(*args: str) -> str:
+    """
+    Runs this script in a fresh process and returns the last line it prints.
+    """
+    result = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), *args],
+        capture_output=True,
+        text=True,
+        check=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    return result.stdout.strip().splitlines()[-1]
+
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--scenario"]:
+        run_scenario(sys.argv[2], sys.argv[3])
+        sys.exit()
+    if sys.argv[1:2] == ["--generate"]:
+        print(write_populations(int(sys.argv[2]), sys.argv[3]))
+        sys.exit()
+
+    sizes = [int(size) for size in sys.argv[1:]] or [
+        10_000,
+        100_000,
+        1_000_000,
+        10_000_000,
+    ]
+    print(
+        f"{'controls':>10} {'cases':>8} {'scenario':>22} {'seconds':>9} "
+        f"{'cases/s':>10} {'peak MB':>9}"
+    )
+    for n_controls in sizes:
+        with tempfile.TemporaryDirectory() as data_path:
+            ## Generate in a separate process too, as peak memory is inherited
+            n_cases = int(run_script("--generate", str(n_controls), data_path))
+            for scenario in SCENARIOS:
+                timing = json.loads(run_script("--scenario", scenario, data_path))
+                peak = timing["peak_rss_mb"]
+                print(
+                    f"{n_controls:>10} {n_cases:>8} {scenario:>22} "
+                    f"{timing['seconds']:>9.2f} "
+                    f"{timing['matched_cases'] / timing['seconds']:>10.0f} "
+                    f"{'n/a' if peak is None else f'{peak:.0f}':>9}"
+                )
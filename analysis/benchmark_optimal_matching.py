@@ -0,0 +1,92 @@
+"""
+Benchmarks optimal_match_stratum against the greedy match_stratum on a single
+synthetic stratum of growing size, and reports how the run time scales.
+
+Usage: python analysis/benchmark_optimal_matching.py [n_cases ...]
+"""
+import sys
+import time
+
+import numpy as np
+
+from osmatching_local import (
+    AssignmentLedger,
+    get_match_priorities,
+    match_stratum,
+    optimal_match_stratum,
+    widen,
+)
+
+MATCHES_PER_CASE = 5
+CONTROLS_PER_CASE = 20
+MATCH_VARIABLES = {"age": 1}
+
+
+def synthetic_stratum(n_cases: int, seed: int = 0):
+    """
+    One stratum (e.g. one sex within one STP) of working-age cases and controls,
+    with ages 18-64 and the age caliper index match_stratum expects.
+    """
+    rng = np.random.default_rng(seed)
+    n_matches = n_cases * CONTROLS_PER_CASE
+    case_ages = widen(rng.integers(18, 65, n_cases).astype(np.int8))
+    match_ages = rng.integers(18, 65, n_matches).astype(np.int8)
+    order = np.argsort(match_ages, kind="stable")
+    return {
+        "case_ids": np.arange(n_cases),
+        "case_values": {"age": case_ages},
+        "case_index_dates": None,
+        "match_values": {"age": match_ages},
+        "match_index_dates": np.full(n_matches, np.datetime64("2020-02-01", "ns")),
+        "match_priorities": get_match_priorities(np.arange(n_matches)),
+        "stratum_matches": np.arange(n_matches),
+        "caliper_indices": {"age": (widen(match_ages[order]), order)},
+    }
+
+
+def run(matcher, stratum: dict) -> tuple:
+    available = np.ones(len(stratum["stratum_matches"]), dtype=bool)
+    ledger = AssignmentLedger()
+    start = time.perf_counter()
+    match_counts = matcher(
+        available=available,
+        ledger=ledger,
+        matches_per_case=MATCHES_PER_CASE,
+        match_variables=MATCH_VARIABLES,
+        closest_match_variables=["age"],
+        **stratum,
+    )
+    seconds = time.perf_counter() - start
+
+    match_positions, set_ids, _ = ledger.to_arrays()
+    case_ages = stratum["case_values"]["age"][set_ids]
+    match_ages = widen(stratum["match_values"]["age"][match_positions])
+    mean_difference = np.abs(case_ages - match_ages).mean()
+    return seconds, match_counts.sum(), mean_difference
+
+
+if __name__ == "__main__":
+    sizes = [int(size) for size in sys.argv[1:]] or [1000, 2000, 4000, 8000, 16000]
+    results = {"greedy": [], "optimal": []}
+    print(
+        f"{'cases':>8} {'matcher':>8} {'seconds':>9} {'matched':>9} "
+        f"{'mean |age diff|':>16}"
+    )
+    for n_cases in sizes:
+        stratum = synthetic_stratum(n_cases)
+        for name, matcher in (
+            ("greedy", match_stratum),
+            ("optimal", optimal_match_stratum),
+        ):
+            seconds, matched, mean_difference = run(matcher, stratum)
+            results[name].append(seconds)
+            print(
+                f"{n_cases:>8} {name:>8} {seconds:>9.2f} {matched:>9} "
+                f"{mean_difference:>16.4f}"
+            )
+
+    ## Slope of log(time) against log(size): 1 is linear, 2 is quadratic
+    for name, seconds in results.items():
+        if len(sizes) > 1:
+            slope = np.polyfit(np.log(sizes), np.log(seconds), 1)[0]
+            print(f"{name} scaling exponent: {slope:.2f}")
@@ -0,0 +1,203 @@
+"""
+Runs several matching jobs in one go, such as the general population matching
+that match_running.py does for each year. Each job matches one case csv against
+one match csv with its own matching options. Jobs that use the same match csv
+(with the same match variables and index dates) are run together in one
+process, which reads and indexes the match csv once for all of them; these
+groups of jobs run concurrently in a process pool.
+
+Usage: python analysis/match_batch.py [--workers N] [year ...]
+"""
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from osmatching_local import (
+    STRATUM_MATCHERS,
+    STREAM_CHUNKSIZE,
+    MatchingReport,
+    MatchingTelemetry,
+    add_month_only_variables,
+    assign_index_dates,
+    match_frames,
+    pre_calculate_indices,
+    read_cohort_csv,
+    replace_month_only_variables,
+    write_matched,
+)
+
+COHORT_PATH = "output/cohorts"
+YEARS = ["2019", "2020", "2021", "2022", "2023", "2024"]
+MATCH_VARIABLES = {
+    "sex": "category",
+    "age": 1,
+    "stp": "category",
+}
+
+
+def general_population_job(year: str) -> Dict:
+    """
+    The job match_running.py runs for year: the year's general population,
+    given index dates from February to December, frequency matched to the
+    COVID cases of that year (2020 for 2019).
+    """
+    case_year = "2020" if year == "2019" else year
+    return {
+        "case_csv": os.path.join(COHORT_PATH, f"input_covid_{case_year}.csv.gz"),
+        "match_csv": os.path.join(
+            COHORT_PATH, f"input_general_match_vars_{year}-02-01.csv.gz"
+        ),
+        "index_date_range": (f"{year}-02-01", f"{year}-12-31"),
+        "output_path": COHORT_PATH,
+        "output_suffix": f"_general_{year}",
+        "output_tables": ("matches",),
+        "options": {
+            "matches_per_case": 5,
+            "match_variables": MATCH_VARIABLES,
+            "closest_match_variables": ["age"],
+            "index_date_variable": "patient_index_date",
+            "matching_type": "frequency",
+        },
+    }
+
+
+def pool_key(job: Dict) -> str:
+    """
+    Jobs with the same key can share the match table read from their match csv.
+    """
+    options = job["options"]
+    return json.dumps(
+        [
+            job["match_csv"],
+            job.get("index_date_range"),
+            options["match_variables"],
+            options["index_date_variable"],
+        ],
+        sort_keys=True,
+        default=str,
+    )
+
+
+def read_match_pool(jobs: List[Dict]) -> Tuple[pd.DataFrame, Optional[Dict]]:
+    """
+    Reads the match csv shared by jobs, with every date variable they use, and
+    gives it index dates drawn uniformly from index_date_range if the jobs have
+    one, seeded chunk by chunk as match_running.py streams them. If any job does
+    individual matching, the indices of the whole match table are built too, as
+    for a cached pool in match.
+    """
+    first = jobs[0]
+    match_variables = first["options"]["match_variables"]
+    index_date_variable = first["options"]["index_date_variable"]
+    date_vars = [
+        var
+        for job in jobs
+        for var in job["options"].get("date_exclusion_variables") or {}
+    ]
+    if first.get("index_date_range") is None:
+        date_vars.append(index_date_variable)
+    matches = read_cohort_csv(
+        first["match_csv"], match_variables, [*dict.fromkeys(date_vars)]
+    )
+    if first.get("index_date_range") is not None:
+        start, end = first["index_date_range"]
+        assign_index_dates(
+            matches, index_date_variable, start, end, chunksize=STREAM_CHUNKSIZE
+        )
+
+    add_month_only_variables(matches, match_variables)
+    indices = None
+    if any(job["options"].get("matching_type") in STRATUM_MATCHERS for job in jobs):
+        pool_variables = dict(match_variables)
+        replace_month_only_variables(pool_variables)
+        indices = pre_calculate_indices(matches, matches, pool_variables)
+    return matches, indices
+
+
+def run_jobs(jobs: List[Dict]) -> List[Tuple[str, int, int]]:
+    """
+    Runs jobs that share a match csv one after another against one read of it,
+    writing each job's report, telemetry and outputs as match does. Returns the
+    output suffix and numbers of matched cases and matches of each job.
+    """
+    matches, indices = read_match_pool(jobs)
+    cases_by_csv: Dict[Tuple, pd.DataFrame] = {}
+    summaries = []
+    for job in jobs:
+        options = job["options"]
+        suffix = job.get("output_suffix", "")
+        output_path = job["output_path"]
+        case_key = (job["case_csv"], pool_key(job))
+        if case_key not in cases_by_csv:
+            cases_by_csv[case_key] = read_cohort_csv(
+                job["case_csv"],
+                options["match_variables"],
+                [
+                    *(options.get("date_exclusion_variables") or {}),
+                    options["index_date_variable"],
+                ],
+            )
+        report = MatchingReport(
+            os.path.join(output_path, f"matching_report{suffix}.txt")
+        )
+        report.add([f"Matching started at: {datetime.now()}"])
+        telemetry = MatchingTelemetry(
+            os.path.join(output_path, f"matching_telemetry{suffix}.jsonl"),
+            matching_type=options.get("matching_type", "individual"),
+            output_suffix=suffix,
+            workers=options.get("workers", 1),
+        )
+        matched_cases, matched_matches, report = match_frames(
+            cases_by_csv[case_key],
+            matches,
+            **options,
+            report=report,
+            telemetry=telemetry,
+            indices=indices,
+        )
+        with telemetry.phase(
+            "write",
+            rows_in={"cases": len(matched_cases), "matches": len(matched_matches)},
+        ):
+            write_matched(
+                matched_cases,
+                matched_matches,
+                output_path,
+                suffix,
+                output_tables=job.get("output_tables", ("combined", "membership")),
+            )
+        summaries.append((suffix, len(matched_cases), len(matched_matches)))
+    return summaries
+
+
+def run_batch(jobs: List[Dict], workers: int = 1) -> List[Tuple[str, int, int]]:
+    """
+    Groups jobs by the match csv they share and runs the groups, in a pool of
+    workers processes if workers is more than 1.
+    """
+    groups: Dict[str, List[Dict]] = {}
+    for job in jobs:
+        groups.setdefault(pool_key(job), []).append(job)
+    if workers > 1 and len(groups) > 1:
+        with ProcessPoolExecutor(max_workers=min(workers, len(groups))) as executor:
+            results = list(executor.map(run_jobs, groups.values()))
+    else:
+        results = [run_jobs(group) for group in groups.values()]
+    return [summary for result in results for summary in result]
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    workers = 1
+    if args[:1] == ["--workers"]:
+        workers, args = int(args[1]), args[2:]
+    years = args or YEARS
+    for suffix, n_cases, n_matches in run_batch(
+        [general_population_job(year) for year in years], workers
+    ):
+        print(f"{suffix}: {n_cases} cases, {n_matches} matches")
@@ -1,6 +1,4 @@
 import sys
-import pandas as pd
-from cohortextractor import expectation_generators
 from osmatching_local import match
 
 year = sys.argv[1]
@@ -9,17 +7,11 @@ if sys.argv[1] == "2019":
 else:
     case_year = year
 
-match_df = pd.read_csv(f"output/cohorts/input_general_match_vars_{year}-02-01.csv.gz")
-match_df["patient_index_date"] = expectation_generators.generate_dates(
-    len(match_df), f"{year}-02-01", f"{year}-12-31", "uniform"
-)["date"]
-match_df.to_csv(
-    f"output/cohorts/input_general_{year}_with_index_date.csv.gz", index=False
-)
-
+## Give the general population its index dates as it is streamed in chunks,
+## rather than writing it out with its index dates only to read it back in
 match(
     case_csv=f"input_covid_{case_year}.csv.gz",
-    match_csv=f"input_general_{year}_with_index_date.csv.gz",
+    match_csv=f"input_general_match_vars_{year}-02-01.csv.gz",
     matches_per_case=5,
     match_variables={
         "sex": "category",
@@ -28,8 +20,11 @@ match(
     },
     closest_match_variables=["age"],
     index_date_variable="patient_index_date",
+    match_index_date_range=(f"{year}-02-01", f"{year}-12-31"),
     output_suffix=f"_general_{year}",
     output_path="output/cohorts",
     input_path="output/cohorts",
     matching_type="frequency",
+    output_tables=("matches",),
+    stream_matches=True,
 )
@@ -0,0 +1,144 @@
+"""
+Covariate balance diagnostics for matched cohorts: standardised mean
+differences, variance ratios and category share differences between the matched
+cases and the matched matches, for use by osmatching_local.
+"""
+from typing import List
+
+import numpy as np
+import pandas as pd
+
+BALANCE_COLUMNS = [
+    "variable",
+    "level",
+    "case_n",
+    "match_n",
+    "case_mean",
+    "match_mean",
+    "standardised_mean_difference",
+    "variance_ratio",
+]
+
+
+def parse_iso_dates(values: pd.Series) -> pd.Series:
+    """
+    Parses a text column holding only YYYY-MM-DD dates (as date variables read
+    without parse_dates are) into datetimes, so they are compared as dates rather
+    than as one category per day. Other columns are returned unchanged.
+    """
+    if not (
+        pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values)
+    ) or isinstance(values.dtype, pd.CategoricalDtype):
+        return values
+    present = values.dropna()
+    if (
+        len(present) == 0
+        or not present.astype(str).str.fullmatch(r"\d{4}-\d{2}-\d{2}").all()
+    ):
+        return values
+    return pd.to_datetime(values, format="%Y-%m-%d")
+
+
+def is_numeric_variable(values: pd.Series) -> bool:
+    return (
+        pd.api.types.is_numeric_dtype(values)
+        or pd.api.types.is_datetime64_any_dtype(values)
+    ) and not isinstance(values.dtype, pd.CategoricalDtype)
+
+
+def numeric_balance(values: pd.Series, is_match: np.ndarray) -> List[dict]:
+    """
+    Mean, variance and standardised mean difference of a numeric (or date)
+    variable for cases and matches, from one pass of bincounts. Dates are
+    compared as days since 1970-01-01; missing values are left out.
+    """
+    if pd.api.types.is_datetime64_any_dtype(values):
+        values = values.to_numpy(dtype="datetime64[ns]")
+        days = values.astype("datetime64[D]").astype(np.float64)
+        days[np.isnat(values)] = np.nan
+        values = days
+    else:
+        values = values.to_numpy(dtype=np.float64, na_value=np.nan)
+    present = ~np.isnan(values)
+    role = is_match[present]
+    ## Centre first so the sums of squares do not lose precision
+    values = values[present]
+    centre = values.mean() if len(values) else 0.0
+    values = values - centre
+
+    n = np.bincount(role, minlength=2)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        means = np.bincount(role, weights=values, minlength=2) / n
+        variances = np.bincount(role, weights=values**2, minlength=2) / n - means**2
+        smd = (means[1] - means[0]) / np.sqrt(variances.mean())
+        variance_ratio = variances[1] / variances[0]
+    return [
+        {
+            "level": "",
+            "case_n": n[0],
+            "match_n": n[1],
+            "case_mean": means[0] + centre,
+            "match_mean": means[1] + centre,
+            "standardised_mean_difference": smd,
+            "variance_ratio": variance_ratio,
+        }
+    ]
+
+
+def categorical_balance(values: pd.Series, is_match: np.ndarray) -> List[dict]:
+    """
+    Share of cases and of matches in each category of a categorical variable,
+    from one bincount over (role, category), with the standardised difference in
+    shares. Missing values are left out.
+    """
+    codes, levels = pd.factorize(values, sort=True)
+    present = codes >= 0
+    counts = np.bincount(
+        is_match[present] * len(levels) + codes[present], minlength=2 * len(levels)
+    ).reshape(2, len(levels))
+    n = counts.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        shares = counts / n[:, None]
+        smd = (shares[1] - shares[0]) / np.sqrt(
+            (shares[0] * (1 - shares[0]) + shares[1] * (1 - shares[1])) / 2
+        )
+    return [
+        {
+            "level": str(level),
+            "case_n": counts[0, number],
+            "match_n": counts[1, number],
+            "case_mean": shares[0, number],
+            "match_mean": shares[1, number],
+            "standardised_mean_difference": smd[number],
+            "variance_ratio": np.nan,
+        }
+        for number, level in enumerate(levels)
+    ]
+
+
+def balance_table(
+    matched_cases: pd.DataFrame,
+    matched_matches: pd.DataFrame,
+    variables: List[str],
+) -> pd.DataFrame:
+    """
+    Describes how well the matched matches are balanced against the matched
+    cases on each of variables found in both tables. Numeric and date variables
+    get one row with their means, standardised mean difference and variance
+    ratio (matches over cases). Categorical variables get one row per category,
+    where the means are the shares of cases and matches in that category.
+    """
+    is_match = np.repeat([0, 1], [len(matched_cases), len(matched_matches)])
+    rows = []
+    for var in dict.fromkeys(variables):
+        if var not in matched_cases or var not in matched_matches:
+            continue
+        case_values = parse_iso_dates(matched_cases[var])
+        match_values = parse_iso_dates(matched_matches[var])
+        values = pd.concat([case_values, match_values], ignore_index=True)
+        if is_numeric_variable(case_values) and is_numeric_variable(match_values):
+            var_rows = numeric_balance(values, is_match)
+        else:
+            var_rows = categorical_balance(values, is_match)
+        rows.extend({"variable": var, **row} for row in var_rows)
+    return pd.DataFrame(rows, columns=BALANCE_COLUMNS)
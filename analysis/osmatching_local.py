@@ -1,13 +1,183 @@
 """Main program that does matching"""
+import contextlib
 import copy
+import functools
+import gzip
+import hashlib
+import io
+import itertools
+import json
 import os
+import pickle
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass, field
 from datetime import datetime
-from typing import Any, Dict, List, Optional, Tuple, Union
+from typing import (
+    IO,
+    Any,
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import numpy as np
 import pandas as pd
+from pandas.api.types import union_categoricals
+
+from matching_balance import balance_table
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
 
 NOT_PREVIOUSLY_MATCHED = -9
+EMPTY_POSITIONS = np.array([], dtype=np.intp)
+STREAM_CHUNKSIZE = 100_000
+## Most cases per task when matching with replacement across workers
+REPLACEMENT_CASES = 5_000
+
+
+def iter_cohort_csv(
+    csv_path: str,
+    match_variables: Dict,
+    date_variables: List[str],
+    keep_columns: Optional[List[str]] = None,
+    chunksize: Optional[int] = None,
+) -> Iterator[pd.DataFrame]:
+    """
+    Reads a cohort csv, parsing the matching variables straight into compact
+    data types: categories for categorical variables, the smallest integer type
+    that holds each caliper variable, and datetime64 for date_variables.
+
+    If keep_columns is given, only patient_id, the matching and date variables and
+    keep_columns are read; otherwise every column is read. Yields the whole csv,
+    or if chunksize is given, chunks of that many rows, each converted before the
+    next is read.
+    """
+    header = pd.read_csv(csv_path, nrows=0).columns
+    usecols = None
+    if keep_columns is not None:
+        wanted = {"patient_id", *match_variables, *date_variables, *keep_columns}
+        usecols = [column for column in header if column in wanted]
+    categorical_vars = [
+        var for var, match_type in match_variables.items() if match_type == "category"
+    ]
+    caliper_vars = [
+        var
+        for var, match_type in match_variables.items()
+        if isinstance(match_type, int)
+    ]
+    reader = pd.read_csv(
+        csv_path,
+        index_col="patient_id",
+        usecols=usecols,
+        dtype={var: "category" for var in categorical_vars if var in header},
+        parse_dates=[var for var in date_variables if var in header],
+        chunksize=chunksize,
+    )
+
+    chunks = [reader] if chunksize is None else reader
+    for chunk in chunks:
+        for var in caliper_vars:
+            if var in chunk and pd.api.types.is_integer_dtype(chunk[var]):
+                chunk[var] = pd.to_numeric(chunk[var], downcast="integer")
+        yield chunk
+
+
+def read_cohort_csv(
+    csv_path: str,
+    match_variables: Dict,
+    date_variables: List[str],
+    keep_columns: Optional[List[str]] = None,
+    chunksize: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    Reads a whole cohort csv with iter_cohort_csv. If chunksize is given, the
+    csv is read that many rows at a time so that the whole file is never held
+    with inferred types, and the chunks are joined at the end.
+    """
+    compact_chunks = list(
+        iter_cohort_csv(
+            csv_path, match_variables, date_variables, keep_columns, chunksize
+        )
+    )
+    if len(compact_chunks) == 1:
+        return compact_chunks[0]
+
+    ## Give every chunk the same categories so that they stay categorical
+    for var, match_type in match_variables.items():
+        if match_type == "category" and var in compact_chunks[0]:
+            categories = union_categoricals(
+                [chunk[var] for chunk in compact_chunks]
+            ).categories
+            for chunk in compact_chunks:
+                chunk[var] = chunk[var].cat.set_categories(categories)
+    return pd.concat(compact_chunks)
+
+
+def add_month_only_variables(cohort: pd.DataFrame, match_variables: Dict) -> None:
+    """
+    Adds a categorical {var}_m variable holding the month ("01" to "12") of each
+    month_only match variable, which may be a YYYY-MM-DD string or already
+    parsed to a date (as the index and date exclusion variables are).
+    """
+    for var, match_type in match_variables.items():
+        if match_type == "month_only":
+            if pd.api.types.is_datetime64_any_dtype(cohort[var]):
+                months = cohort[var].dt.strftime("%m")
+            else:
+                months = cohort[var].str.slice(start=5, stop=7)
+            cohort[f"{var}_m"] = months.astype("category")
+
+
+def replace_month_only_variables(match_variables: Dict) -> None:
+    """
+    Replaces each month_only match variable with its categorical {var}_m variable.
+    """
+    month_only = [
+        var for var, match_type in match_variables.items() if match_type == "month_only"
+    ]
+    for var in month_only:
+        del match_variables[var]
+        match_variables[f"{var}_m"] = "category"
+
+
+def share_categories(frames: List[pd.DataFrame], match_variables: Dict) -> None:
+    """
+    Encodes each categorical match variable against one category dictionary,
+    the union of its categories in all of frames, so that the same value has the
+    same integer code in every frame. Categories of the first frame keep their
+    codes, and those only found in later frames are added after them.
+    """
+    for var, match_type in match_variables.items():
+        if match_type != "category":
+            continue
+        for frame in frames:
+            if not isinstance(frame[var].dtype, pd.CategoricalDtype):
+                frame[var] = frame[var].astype("category")
+        categories = union_categoricals([frame[var] for frame in frames]).categories
+        for frame in frames:
+            if not frame[var].cat.categories.equals(categories):
+                frame[var] = frame[var].cat.set_categories(categories)
+
+
+def stratum_codes(frame: pd.DataFrame, categorical_vars: List[str]) -> pd.DataFrame:
+    """
+    The category codes of the categorical match variables of frame, with -1 for
+    missing values. Strata are looked up by tuples of these codes.
+    """
+    return pd.DataFrame(
+        {var: frame[var].cat.codes.to_numpy() for var in categorical_vars},
+        index=frame.index,
+    )
 
 
 def import_csvs(
@@ -18,49 +188,198 @@ def import_csvs(
     index_date_variable: str,
     input_path: str = "tests/test_data",
     replace_match_index_date_with_case: Optional[str] = None,
+    keep_columns: Optional[List[str]] = None,
+    chunksize: Optional[int] = None,
+    match_index_date_range: Optional[Tuple[str, str]] = None,
 ) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     Imports the two csvs specified under case_csv and match_csv.
-    Also sets the correct data types for the matching variables.
+    Also sets the correct data types for the matching variables, with the
+    categories of each categorical variable shared between cases and matches.
+    keep_columns and chunksize are passed to read_cohort_csv, to read only the
+    columns needed (plus any others asked for) and to read in chunks. If
+    match_index_date_range is given, the matches are given index dates drawn
+    from it, as match streams them.
     """
-    cases = pd.read_csv(
+    exclusion_vars = [*(date_exclusion_variables or {})]
+    cases = read_cohort_csv(
         os.path.join(input_path, f"{case_csv}"),
-        index_col="patient_id",
+        match_variables,
+        [*exclusion_vars, index_date_variable],
+        keep_columns,
+        chunksize,
     )
-    matches = pd.read_csv(
+    if replace_match_index_date_with_case is None:
+        match_date_vars = [*exclusion_vars, index_date_variable]
+    else:
+        match_date_vars = exclusion_vars
+    matches = read_cohort_csv(
         os.path.join(input_path, f"{match_csv}"),
-        index_col="patient_id",
+        match_variables,
+        match_date_vars,
+        keep_columns,
+        chunksize,
     )
+    if match_index_date_range is not None:
+        assign_index_dates(
+            matches,
+            index_date_variable,
+            *match_index_date_range,
+            chunksize=chunksize or STREAM_CHUNKSIZE,
+        )
 
-    ## Set data types for matching variables
-    month_only = []
-    for var, match_type in match_variables.items():
-        if match_type == "category":
-            cases[var] = cases[var].astype("category")
-            matches[var] = matches[var].astype("category")
-        ## Extract month from month_only variables
-        elif match_type == "month_only":
-            month_only.append(var)
-            cases[f"{var}_m"] = cases[var].str.slice(start=5, stop=7).astype("category")
-            matches[f"{var}_m"] = (
-                matches[var].str.slice(start=5, stop=7).astype("category")
+    ## Extract month from month_only variables
+    add_month_only_variables(cases, match_variables)
+    add_month_only_variables(matches, match_variables)
+    replace_month_only_variables(match_variables)
+    share_categories([matches, cases], match_variables)
+
+    return cases, matches
+
+
+def match_pool_key(match_csv_path: str, pool_spec: Dict) -> str:
+    """
+    Hashes the contents of the match csv together with the parts of the matching
+    specification that shape the prepared match table and its indices.
+    """
+    key = hashlib.sha256()
+    with open(match_csv_path, "rb") as csv_file:
+        for block in iter(lambda: csv_file.read(1 << 20), b""):
+            key.update(block)
+    key.update(json.dumps(pool_spec, sort_keys=True, default=str).encode())
+    return key.hexdigest()[:16]
+
+
+def save_match_pool(pool_dir: str, matches: pd.DataFrame, indices: Dict) -> None:
+    """
+    Saves the prepared match table and its indices (from pre_calculate_indices) to
+    pool_dir. Every column and index is stored as a .npy array so that
+    load_match_pool can memory-map it; categorical (and text) columns are stored
+    as integer codes, with their categories kept in the pool.pkl metadata.
+    The directory is written under a temporary name and then moved into place.
+    """
+    tmp_dir = f"{pool_dir}.tmp{os.getpid()}"
+    os.makedirs(tmp_dir, exist_ok=True)
+    metadata: Dict = {"index_name": matches.index.name, "columns": [], "indices": {}}
+
+    np.save(os.path.join(tmp_dir, "patient_id.npy"), matches.index.to_numpy())
+    for number, (column, values) in enumerate(matches.items()):
+        categories = None
+        if not isinstance(values.dtype, pd.CategoricalDtype) and (
+            pd.api.types.is_object_dtype(values) or pd.api.types.is_string_dtype(values)
+        ):
+            values = values.astype("category")
+        if isinstance(values.dtype, pd.CategoricalDtype):
+            categories = values.cat.categories
+            values = values.cat.codes
+        np.save(os.path.join(tmp_dir, f"column_{number}.npy"), values.to_numpy())
+        metadata["columns"].append((column, categories))
+
+    for number, (match_var, index) in enumerate(indices.items()):
+        keys = list(index)
+        entries = [
+            entry if isinstance(entry, tuple) else (entry,) for entry in index.values()
+        ]
+        offsets = np.cumsum([0, *(len(entry[0]) for entry in entries)])
+        for part in range(len(entries[0]) if entries else 0):
+            np.save(
+                os.path.join(tmp_dir, f"index_{number}_{part}.npy"),
+                np.concatenate([entry[part] for entry in entries]),
             )
-    for var in month_only:
-        del match_variables[var]
-        match_variables[f"{var}_m"] = "category"
+        np.save(os.path.join(tmp_dir, f"index_{number}_offsets.npy"), offsets)
+        metadata["indices"][match_var] = (
+            number,
+            keys,
+            len(entries[0]) if entries else 0,
+        )
+
+    with open(os.path.join(tmp_dir, "pool.pkl"), "wb") as metadata_file:
+        pickle.dump(metadata, metadata_file)
+    os.replace(tmp_dir, pool_dir)
+
+
+def load_match_pool(pool_dir: str) -> Tuple[pd.DataFrame, Dict]:
+    """
+    Loads a match table and indices saved by save_match_pool, memory-mapping the
+    arrays rather than reading them into memory.
+    """
+    with open(os.path.join(pool_dir, "pool.pkl"), "rb") as metadata_file:
+        metadata = pickle.load(metadata_file)
 
-    ## Format exclusion variables as dates
-    if date_exclusion_variables is not None:
-        for var in date_exclusion_variables:
-            cases[var] = pd.to_datetime(cases[var])
-            matches[var] = pd.to_datetime(matches[var])
+    def load(name: str) -> np.ndarray:
+        return np.load(os.path.join(pool_dir, f"{name}.npy"), mmap_mode="r")
+
+    columns = {}
+    for number, (column, categories) in enumerate(metadata["columns"]):
+        values = load(f"column_{number}")
+        if categories is not None:
+            values = pd.Categorical.from_codes(values, categories=categories)
+        columns[column] = values
+    matches = pd.DataFrame(
+        columns,
+        index=pd.Index(load("patient_id"), name=metadata["index_name"]),
+        copy=False,
+    )
+
+    indices: Dict = {}
+    for match_var, (number, keys, parts) in metadata["indices"].items():
+        offsets = load(f"index_{number}_offsets")
+        arrays = [load(f"index_{number}_{part}") for part in range(parts)]
+        indices[match_var] = {}
+        for entry, key in enumerate(keys):
+            start, stop = offsets[entry], offsets[entry + 1]
+            entry_arrays = tuple(array[start:stop] for array in arrays)
+            indices[match_var][key] = (
+                entry_arrays if len(entry_arrays) > 1 else entry_arrays[0]
+            )
+    return matches, indices
+
+
+def get_match_pool(
+    match_csv: str,
+    match_variables: Dict,
+    date_exclusion_variables: Optional[Dict[Any, Any]],
+    index_date_variable: str,
+    input_path: str,
+    replace_match_index_date_with_case: Optional[str],
+    keep_columns: Optional[List[str]],
+    chunksize: Optional[int],
+    pool_cache_path: str,
+) -> Tuple[pd.DataFrame, Dict]:
+    """
+    Returns the prepared match table and its indices, covering every stratum in
+    the match table rather than just those of one case file. These are loaded
+    from pool_cache_path if they have been saved there for the same match csv and
+    specification, and otherwise are prepared from the csv and saved.
+    match_variables should still contain any month_only variables.
+    """
+    match_csv_path = os.path.join(input_path, f"{match_csv}")
+    pool_spec = {
+        "match_variables": match_variables,
+        "date_exclusion_variables": date_exclusion_variables,
+        "index_date_variable": index_date_variable,
+        "replace_match_index_date_with_case": replace_match_index_date_with_case,
+        "keep_columns": keep_columns,
+        "index_keys": "category_codes",
+    }
+    pool_dir = os.path.join(pool_cache_path, match_pool_key(match_csv_path, pool_spec))
+    if os.path.isdir(pool_dir):
+        return load_match_pool(pool_dir)
 
-    ## Format index date as date
-    cases[index_date_variable] = pd.to_datetime(cases[index_date_variable])
+    date_vars = [*(date_exclusion_variables or {})]
     if replace_match_index_date_with_case is None:
-        matches[index_date_variable] = pd.to_datetime(matches[index_date_variable])
+        date_vars.append(index_date_variable)
+    matches = read_cohort_csv(
+        match_csv_path, match_variables, date_vars, keep_columns, chunksize
+    )
+    add_month_only_variables(matches, match_variables)
+    pool_variables = copy.deepcopy(match_variables)
+    replace_month_only_variables(pool_variables)
+    indices = pre_calculate_indices(matches, matches, pool_variables)
 
-    return cases, matches
+    os.makedirs(pool_cache_path, exist_ok=True)
+    save_match_pool(pool_dir, matches, indices)
+    return load_match_pool(pool_dir)
 
 
 def add_variables(
@@ -82,61 +401,152 @@ def add_variables(
     return cases, matches
 
 
-def get_bool_index(
-    match_type: str, value: int, match_var: str, matches: pd.DataFrame
-) -> pd.Series:
+def widen(values: np.ndarray) -> np.ndarray:
     """
-    Compares the value in the given case variable to the variable in
-    the match dataframe, to generate a boolean Series. Comparisons vary
-    according to the matching specification.
+    Upcasts compact integer arrays to int64, so that differences and comparisons
+    against case values can neither overflow nor force a conversion of the array.
     """
-    if match_type == "category":
-        bool_index = matches[match_var] == value
-    elif isinstance(match_type, int):
-        bool_index = abs(matches[match_var] - value) <= match_type
-    else:
-        raise Exception(f"Matching type '{match_type}' not yet implemented")
-    return bool_index
+    if values.dtype.kind in "iu":
+        return values.astype(np.int64, copy=False)
+    return values
+
+
+def split_match_variables(match_variables: Dict) -> Tuple[List[str], List[str]]:
+    """
+    Splits the match variables into categorical (exact) and caliper (integer
+    match type, e.g. "age": 1) variables, preserving the order they are given in.
+    """
+    categorical_vars = []
+    caliper_vars = []
+    for match_var, match_type in match_variables.items():
+        if match_type == "category":
+            categorical_vars.append(match_var)
+        elif isinstance(match_type, int):
+            caliper_vars.append(match_var)
+        else:
+            raise Exception(f"Matching type '{match_type}' not yet implemented")
+    return categorical_vars, caliper_vars
+
+
+def intersect_buckets(buckets: List[np.ndarray], n_matches: int) -> np.ndarray:
+    """
+    Intersects sorted arrays of match table positions, starting from the smallest.
+    With no buckets, every position in the match table is returned.
+    """
+    if not buckets:
+        return np.arange(n_matches)
+    buckets = sorted(buckets, key=len)
+    positions = buckets[0]
+    for bucket in buckets[1:]:
+        if len(positions) == 0:
+            break
+        positions = np.intersect1d(positions, bucket, assume_unique=True)
+    return positions
 
 
 def pre_calculate_indices(
     cases: pd.DataFrame, matches: pd.DataFrame, match_variables: Dict
-) -> Dict[str, str]:
+) -> Dict[str, Dict[Any, Any]]:
     """
-    Loops over each of the values in the case table for each of the match
-    variables and generates a boolean Series against the match table. These are
-    returned in a dict.
+    Builds an index for each of the match variables, returned in a dict keyed by
+    variable.
+
+    Categorical variables get a bucket index: for each category code in the case
+    table, the sorted integer positions of the rows in the match table with that
+    code. Buckets partition the match table, so the index holds each match once
+    per variable rather than one full-length mask per value. Cases and matches
+    must share their categories (see share_categories).
+
+    Caliper variables get a sorted-array index inside each categorical bucket:
+    for each tuple of categorical codes in the case table (the stratum), the
+    values of the variable among the matches in that stratum in ascending order,
+    alongside their match table positions. Matches within the caliper of a case
+    value are then a contiguous range found by binary search.
     """
+    categorical_vars, caliper_vars = split_match_variables(match_variables)
     indices_dict: Dict = {}
-    for match_var in match_variables:
-        match_type = match_variables[match_var]
+    for match_var in categorical_vars:
         indices_dict[match_var] = {}
+        ## Sort positions by code in one pass; missing values (-1) sort first
+        match_codes = matches[match_var].cat.codes.to_numpy()
+        order = np.argsort(match_codes, kind="stable")
+        offsets = np.searchsorted(
+            match_codes[order], np.arange(len(matches[match_var].cat.categories) + 1)
+        )
+        case_codes = np.unique(cases[match_var].cat.codes.to_numpy())
+        for code in case_codes[case_codes >= 0]:
+            if offsets[code + 1] > offsets[code]:
+                indices_dict[match_var][int(code)] = order[
+                    offsets[code] : offsets[code + 1]
+                ]
 
-        values = cases[match_var].unique()
-        for value in values:
-            index = get_bool_index(match_type, value, match_var, matches)
-            indices_dict[match_var][value] = index
+    if caliper_vars:
+        if categorical_vars:
+            strata = stratum_codes(cases, categorical_vars).drop_duplicates()
+            strata = list(strata.itertuples(index=False, name=None))
+        else:
+            strata = [()]
+        for match_var in caliper_vars:
+            indices_dict[match_var] = {}
+        for stratum in strata:
+            positions = intersect_buckets(
+                [
+                    indices_dict[match_var].get(value, EMPTY_POSITIONS)
+                    for match_var, value in zip(categorical_vars, stratum)
+                ],
+                len(matches),
+            )
+            for match_var in caliper_vars:
+                values = matches[match_var].to_numpy()[positions]
+                not_missing = ~pd.isna(values)
+                values, stratum_positions = values[not_missing], positions[not_missing]
+                order = np.argsort(values, kind="stable")
+                indices_dict[match_var][stratum] = (
+                    widen(values[order]),
+                    stratum_positions[order],
+                )
     return indices_dict
 
 
 def get_eligible_matches(
-    case_row: pd.DataFrame,
-    matches: pd.DataFrame,
+    case_values: Dict[str, Any],
+    match_values: Dict[str, np.ndarray],
     match_variables: Dict,
-    indices: pd.DataFrame,
-) -> pd.DataFrame:
+    caliper_indices: Dict[str, Tuple[np.ndarray, np.ndarray]],
+    stratum_matches: np.ndarray,
+) -> np.ndarray:
     """
-    Loops over the match_variables and combines the boolean Series
-    from pre_calculate_indices into a single bool Series. Also removes previously
-    matched patients.
+    Finds the matches within a stratum that are eligible for the case, returned as
+    a sorted array of match table positions. Where there are caliper variables,
+    the narrowest caliper range is looked up by binary search in caliper_indices
+    (sorted values and the positions they came from) and then checked against the
+    other caliper variables. With no caliper variables every match in the stratum
+    (stratum_matches) is eligible.
     """
-    eligible_matches = pd.Series(data=True, index=matches.index)
-    for match_var in match_variables:
-        variable_bool = indices[match_var][case_row[match_var]]
-        eligible_matches = eligible_matches & variable_bool
+    if not caliper_indices:
+        return stratum_matches
 
-    not_previously_matched = matches["set_id"] == NOT_PREVIOUSLY_MATCHED
-    eligible_matches = eligible_matches & not_previously_matched
+    caliper_ranges = []
+    for match_var, (sorted_values, positions) in caliper_indices.items():
+        value = case_values[match_var]
+        if pd.isna(value):
+            return EMPTY_POSITIONS
+        caliper = match_variables[match_var]
+        lowest, highest = value - caliper, value + caliper
+        if sorted_values.dtype.kind == "i":
+            lowest, highest = np.int64(np.ceil(lowest)), np.int64(np.floor(highest))
+        start = np.searchsorted(sorted_values, lowest, side="left")
+        stop = np.searchsorted(sorted_values, highest, side="right")
+        caliper_ranges.append((stop - start, match_var, positions[start:stop]))
+    caliper_ranges.sort(key=lambda caliper_range: caliper_range[0])
+
+    eligible_matches = np.sort(caliper_ranges[0][2])
+    for _, match_var, _ in caliper_ranges[1:]:
+        values = widen(match_values[match_var][eligible_matches])
+        within_caliper = (
+            abs(values - case_values[match_var]) <= match_variables[match_var]
+        )
+        eligible_matches = eligible_matches[within_caliper]
     return eligible_matches
 
 
@@ -159,292 +569,2230 @@ def date_exclusions(df1: pd.DataFrame, date_exclusion_variables: Dict, index_dat
     return exclusions
 
 
+def exclude_by_index_date(
+    eligible_matches: np.ndarray,
+    match_values: Dict[str, np.ndarray],
+    date_exclusion_variables: Dict,
+    index_date: Any,
+) -> np.ndarray:
+    """
+    Array version of date_exclusions: drops the eligible_matches positions that
+    have an exclusion variable before (or after) the index date. index_date can
+    be a single date or one date per eligible match.
+    """
+    exclusions = np.zeros(len(eligible_matches), dtype=bool)
+    for exclusion_var, before_after in date_exclusion_variables.items():
+        exclusion_dates = match_values[exclusion_var][eligible_matches]
+        if before_after == "before":
+            exclusions |= exclusion_dates < index_date
+        else:
+            exclusions |= exclusion_dates > index_date
+    return eligible_matches[~exclusions]
+
+
+class RiskSet:
+    """
+    Tracks which matches of a stratum are still at risk as cases are taken in
+    index date order, for matches that take their index date from the case. A
+    match leaves the risk set once the index date passes its "before" exclusion
+    date, and joins it once the index date reaches its "after" exclusion date.
+    The exclusion dates are sorted once, and each match's flag in a mask indexed
+    by match table position (like available) is updated when it crosses a
+    boundary, so checking the eligible matches of a case is a single gather.
+    """
+
+    def __init__(
+        self,
+        stratum_matches: np.ndarray,
+        match_values: Dict[str, np.ndarray],
+        date_exclusion_variables: Dict,
+        n_matches: int,
+    ):
+        self.events = {}
+        self.crossed = {}
+        for exclusion_var, before_after in date_exclusion_variables.items():
+            exclusion_dates = match_values[exclusion_var][stratum_matches]
+            ## Missing dates sort last, so they are never crossed
+            order = np.argsort(exclusion_dates, kind="stable")
+            self.events[exclusion_var] = (
+                before_after,
+                exclusion_dates[order],
+                order,
+                stratum_matches[order],
+            )
+            self.crossed[exclusion_var] = 0
+        self.left = np.zeros(len(stratum_matches), dtype=bool)
+        ## Number of "after" dates each match is still waiting for
+        self.waiting = np.zeros(len(stratum_matches), dtype=np.int64)
+        for before_after, exclusion_dates, order, _ in self.events.values():
+            if before_after == "after":
+                self.waiting[order[~np.isnat(exclusion_dates)]] += 1
+        ## Only the stratum's positions are ever set, so the pages of a large
+        ## match table outside the stratum are never touched
+        self.mask = np.zeros(n_matches, dtype=bool)
+        self.mask[stratum_matches] = self.waiting == 0
+
+    def at_risk(self, eligible_matches: np.ndarray, index_date: Any) -> np.ndarray:
+        """
+        Moves the risk set on to index_date, which must not be earlier than the
+        last one, and flags which of the eligible_matches positions are at risk.
+        """
+        if np.isnat(index_date):
+            return np.ones(len(eligible_matches), dtype=bool)
+        for exclusion_var, (
+            before_after,
+            exclusion_dates,
+            order,
+            positions,
+        ) in self.events.items():
+            ## Matches leave when their "before" date is earlier than the index
+            ## date, and join when their "after" date is no later than it
+            side = "left" if before_after == "before" else "right"
+            crossed = np.searchsorted(exclusion_dates, index_date, side=side)
+            if crossed <= self.crossed[exclusion_var]:
+                continue
+            newly_crossed = order[self.crossed[exclusion_var] : crossed]
+            if before_after == "before":
+                self.left[newly_crossed] = True
+            else:
+                self.waiting[newly_crossed] -= 1
+            self.mask[positions[self.crossed[exclusion_var] : crossed]] = ~self.left[
+                newly_crossed
+            ] & (self.waiting[newly_crossed] == 0)
+            self.crossed[exclusion_var] = crossed
+        return self.mask[eligible_matches]
+
+
+def combine_date_exclusions(
+    matches: pd.DataFrame, date_exclusion_variables: Dict
+) -> Tuple[Dict[str, np.ndarray], Dict[str, str]]:
+    """
+    Collapses the date exclusion variables of the matches into the earliest
+    "before" date and the latest "after" date of each match, so that excluding
+    matches at an index date takes one comparison per direction rather than one
+    per exclusion variable. Returns the combined dates, and the date exclusion
+    variables to use with them in exclude_by_index_date.
+    """
+    exclusion_dates: Dict[str, np.ndarray] = {}
+    combined_exclusion_variables: Dict[str, str] = {}
+    for before_after, combine in (("before", np.fmin), ("after", np.fmax)):
+        exclusion_vars = [
+            exclusion_var
+            for exclusion_var, direction in date_exclusion_variables.items()
+            if direction == before_after
+        ]
+        if exclusion_vars:
+            ## fmin and fmax ignore missing dates
+            exclusion_dates[f"exclusion_date_{before_after}"] = functools.reduce(
+                combine, [matches[var].to_numpy() for var in exclusion_vars]
+            )
+            combined_exclusion_variables[f"exclusion_date_{before_after}"] = (
+                before_after
+            )
+    return exclusion_dates, combined_exclusion_variables
+
+
+def get_match_priorities(match_ids: np.ndarray, seed: int = 123) -> np.ndarray:
+    """
+    Gives each match a random priority key, used to break ties between matches
+    that are equally close to a case. The key is a hash of the pair (match ID,
+    seed), so a match keeps its key whatever else is in the pool and whatever
+    order the cases are matched in, and different seeds give different keys.
+    (hash_array on its own ignores its hash_key for numeric IDs.)
+    """
+    match_ids = np.asarray(match_ids)
+    return pd.util.hash_pandas_object(
+        pd.DataFrame({"id": match_ids, "seed": np.full(len(match_ids), seed)}),
+        index=False,
+    ).to_numpy()
+
+
 def greedily_pick_matches(
     matches_per_case: int,
-    matched_rows: pd.DataFrame,
-    case_row: pd.DataFrame,
+    eligible_matches: np.ndarray,
+    case_values: Dict[str, Any],
+    match_values: Dict[str, np.ndarray],
+    match_priorities: np.ndarray,
     closest_match_variables: Union[None, List] = None,
-) -> pd.Index:
+) -> np.ndarray:
     """
-    Cuts the eligible_matches list to the number of matches specified. This is a
-    greedy matching method, so if closest_match_variables are specified, it picks the
-    values that deviate least from the case values (prioritised in the order they are
-    specified). If there are more than matches_per_case matches who are identical,
-    matches are randomly sampled.
+    Cuts the eligible_matches positions to the number of matches specified. This is
+    a greedy matching method, so if closest_match_variables are specified, it picks
+    the values that deviate least from the case values (prioritised in the order
+    they are specified). Ties are broken by match_priorities, the random key of
+    each match, so only the matches picked need to be put in order. A single
+    integer closest match variable is packed with the priorities into one key;
+    several variables are sorted on together.
     """
-    if closest_match_variables is not None:
-        sort_cols: List = []
-        for var in closest_match_variables:
-            matched_rows[f"{var}_delta"] = abs(matched_rows[var] - case_row[var])
-            sort_cols.append(f"{var}_delta")
-        matched_rows = matched_rows.nsmallest(matches_per_case, sort_cols, keep="all")
+    if len(eligible_matches) <= matches_per_case:
+        return eligible_matches
 
-    if len(matched_rows) > matches_per_case:
-        matched_rows = matched_rows.sample(n=matches_per_case, random_state=123)
-    return matched_rows.index
+    priorities = match_priorities[eligible_matches]
+    if closest_match_variables is None:
+        picked = np.argpartition(priorities, matches_per_case - 1)
+        return eligible_matches[picked[:matches_per_case]]
 
+    deltas = [
+        abs(widen(match_values[var][eligible_matches]) - case_values[var])
+        for var in closest_match_variables
+    ]
+    if len(deltas) == 1 and deltas[0].dtype.kind in "iu" and deltas[0].max() < 2**31:
+        ## One key per match, the delta above the top half of the priority, so a
+        ## single partition finds the closest matches. Only the matches up to the
+        ## matches_per_case-th key are sorted, by the full priority within a key
+        keys = (deltas[0].astype(np.uint64) << np.uint64(32)) | (
+            priorities >> np.uint64(32)
+        )
+        cutoff = np.partition(keys, matches_per_case - 1)[matches_per_case - 1]
+        candidates = np.flatnonzero(keys <= cutoff)
+        order = np.lexsort((priorities[candidates], keys[candidates]))
+        return eligible_matches[candidates[order[:matches_per_case]]]
 
-def get_date_offset(offset_str: str) -> Optional[pd.DataFrame]:
+    ## Only matches at least as close on the first variable as the
+    ## matches_per_case-th closest can be picked
+    cutoff = np.partition(deltas[0], matches_per_case - 1)[matches_per_case - 1]
+    if pd.isna(cutoff):
+        candidates = np.arange(len(eligible_matches))
+    else:
+        candidates = np.flatnonzero(deltas[0] <= cutoff)
+    order = np.lexsort(
+        [priorities[candidates], *(delta[candidates] for delta in deltas[::-1])]
+    )
+    return eligible_matches[candidates[order[:matches_per_case]]]
+
+
+@dataclass
+class AssignmentLedger:
     """
-    Parses the string given by replace_match_index_date_with_case
-    to determine the unit and length of offset.
-    Returns a pr.DateOffset of the appropriate length.
+    Append-only record of the matches assigned to each case: the match table
+    positions picked, the case ID they were assigned to and, where matches take
+    their index date from the case, that index date. Entries are only appended,
+    so the ledger can be turned into the output tables in one operation at the
+    end of matching.
     """
-    if offset_str == "no_offset":
-        offset = None
-    else:
-        length = int(offset_str.split("_")[0])
-        unit = offset_str.split("_")[1]
-        if unit in ("year", "years"):
-            offset = pd.DateOffset(years=length)
-        elif unit in ("month", "months"):
-            offset = pd.DateOffset(months=length)
-        elif unit in ("day", "days"):
-            offset = pd.DateOffset(days=length)
-        else:
-            raise Exception(f"Date offset '{unit}' not implemented")
-    return offset
 
+    match_positions: List[np.ndarray] = field(default_factory=list)
+    set_ids: List[np.ndarray] = field(default_factory=list)
+    index_dates: List[np.ndarray] = field(default_factory=list)
 
-def match(
-    case_csv: str,
-    match_csv: str,
+    def append(self, match_positions: np.ndarray, set_id: Any, index_date: Any):
+        if index_date is None:
+            index_date = np.datetime64("NaT")
+        self.extend(
+            match_positions,
+            np.full(len(match_positions), set_id),
+            np.full(len(match_positions), index_date, dtype="datetime64[ns]"),
+        )
+
+    def extend(
+        self, match_positions: np.ndarray, set_ids: np.ndarray, index_dates: np.ndarray
+    ):
+        self.match_positions.append(match_positions)
+        self.set_ids.append(set_ids)
+        self.index_dates.append(index_dates)
+
+    def to_arrays(self) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """
+        Returns one entry per assigned match: its match table position, its
+        set_id, and its index date (NaT where the match keeps its own).
+        """
+        if not self.match_positions:
+            return EMPTY_POSITIONS, np.array([]), np.array([], dtype="datetime64[ns]")
+        return (
+            np.concatenate(self.match_positions),
+            np.concatenate(self.set_ids),
+            np.concatenate(self.index_dates),
+        )
+
+
+def match_stratum(
+    case_ids: np.ndarray,
+    case_values: Dict[str, np.ndarray],
+    case_index_dates: Optional[np.ndarray],
+    match_values: Dict[str, np.ndarray],
+    match_index_dates: np.ndarray,
+    match_priorities: np.ndarray,
+    stratum_matches: np.ndarray,
+    caliper_indices: Dict[str, Tuple[np.ndarray, np.ndarray]],
+    available: np.ndarray,
+    ledger: AssignmentLedger,
     matches_per_case: int,
     match_variables: Dict,
-    index_date_variable: str,
-    matching_type: str = "individual",
     closest_match_variables: Optional[List[Any]] = None,
     date_exclusion_variables: Optional[Dict[Any, Any]] = None,
     min_matches_per_case: int = 0,
-    replace_match_index_date_with_case: Optional[str] = None,
-    indicator_variable_name: str = "case",
-    output_suffix: str = "",
-    output_path: str = "tests/test_output",
-    input_path: str = "tests/test_data",
-    drop_cases_from_matches: bool = False,
-) -> None:
-    """
-    Wrapper function that calls functions to:
-    - import data
-    - find eligible matches
-    - pick the correct number of randomly allocated matches
-    - make exclusions that are based on index date
-      - (this is not currently possible in a study definition, and will only ever be possible
-        during matching for studies where the match index date comes from the case)
-    - set the set_id as that of the case_id (this excludes them from being matched later)
-    - set the index date of the match as that of the case (where desired)
-    - save the results as a csv
+    with_replacement: bool = False,
+) -> np.ndarray:
     """
-    if min_matches_per_case > matches_per_case:
-        raise ValueError("min_matches_per_case cannot be greater than matches_per_case")
-
-    report_path = os.path.join(
-        output_path,
-        f"matching_report{output_suffix}.txt",
-    )
+    Greedily matches the cases of a single stratum (one combination of the
+    categorical match variables), in the order given, against the matches in that
+    stratum. Everything is held as NumPy arrays indexed by match table position:
+    - case_values and match_values hold the caliper, closest-match and (for
+      matches) date exclusion variables
+    - case_index_dates are the index dates to give matches of each case, or None
+      if matches keep their own match_index_dates
+    - match_priorities are the random keys that break ties between matches, from
+      get_match_priorities
+    - stratum_matches are the sorted positions of the matches in the stratum, and
+      caliper_indices map each caliper variable to the sorted values and positions
+      of those matches
+    - available flags the matches that have not yet been matched, and is updated
+      in place as matches are assigned, unless matching with_replacement (when
+      cases do not depend on each other, and can be matched in any order)
 
-    def matching_report(text_to_write: List, erase: bool = False) -> None:
-        if erase and os.path.isfile(report_path):
-            os.remove(report_path)
+    When matches take their index dates from the cases, case_index_dates must be
+    in order, and the date exclusions are applied with a RiskSet. Assignments are
+    appended to the ledger. Returns the number of matches found for each case.
+    """
+    match_counts = np.zeros(len(case_ids), dtype=np.int64)
 
-        os.makedirs(output_path, exist_ok=True)
-        with open(report_path, "w+") as txt:
-            for line in text_to_write:
-                txt.writelines(f"{line}\n")
-                print(line)
-            txt.writelines("\n")
-            print("\n")
-
-    matching_report(
-        [f"Matching started at: {datetime.now()}"],
-        erase=True,
-    )
+    ## Cases come in index date order, so with index dates taken from the cases
+    ## the date exclusions can be swept forward as matching goes
+    risk_set = None
+    if date_exclusion_variables is not None and case_index_dates is not None:
+        risk_set = RiskSet(
+            stratum_matches, match_values, date_exclusion_variables, len(available)
+        )
 
-    ## Deep copy match_variables
-    match_variables = copy.deepcopy(match_variables)
+    for case_number, case_id in enumerate(case_ids):
+        case_row = {var: values[case_number] for var, values in case_values.items()}
 
-    ## Import_data
-    cases, matches = import_csvs(
-        case_csv,
-        match_csv,
-        match_variables,
-        date_exclusion_variables,
-        index_date_variable,
-        input_path,
-        replace_match_index_date_with_case,
-    )
+        ## Get eligible matches
+        eligible_matches = get_eligible_matches(
+            case_row, match_values, match_variables, caliper_indices, stratum_matches
+        )
+        eligible_matches = eligible_matches[available[eligible_matches]]
 
-    matching_report(
-        [
-            "CSV import:",
-            f"Completed {datetime.now()}",
-            f"Cases    {len(cases)}",
-            f"Matches  {len(matches)}",
-        ],
-    )
+        ## Determine match index date
+        if case_index_dates is None:
+            index_date = match_index_dates[eligible_matches]
+        else:
+            index_date = case_index_dates[case_number]
 
-    ## Drop cases from match population if specified
-    if drop_cases_from_matches:
-        matches = matches.drop(cases.index, errors="ignore")
+        ## Index date based match exclusions
+        if risk_set is not None:
+            eligible_matches = eligible_matches[
+                risk_set.at_risk(eligible_matches, index_date)
+            ]
+        elif date_exclusion_variables is not None:
+            eligible_matches = exclude_by_index_date(
+                eligible_matches, match_values, date_exclusion_variables, index_date
+            )
 
-    matching_report(
-        [
-            "Dropping cases from matches:",
-            f"Completed {datetime.now()}",
-            f"Cases    {len(cases)}",
-            f"Matches  {len(matches)}",
-        ]
-    )
+        ## Pick random matches
+        matched = greedily_pick_matches(
+            matches_per_case,
+            eligible_matches,
+            case_row,
+            match_values,
+            match_priorities,
+            closest_match_variables,
+        )
 
-    def individual_matching(cases: pd.DataFrame, matches: pd.DataFrame):
-        ## Add set_id variable
-        cases, matches = add_variables(cases, matches, indicator_variable_name)
+        ## Assign matches to the case if there are enough
+        match_counts[case_number] = len(matched)
+        if len(matched) >= min_matches_per_case:
+            if not with_replacement:
+                available[matched] = False
+            ledger.append(
+                matched, case_id, None if case_index_dates is None else index_date
+            )
 
-        indices = pre_calculate_indices(cases, matches, match_variables)
-        matching_report([f"Completed pre-calculating indices at {datetime.now()}"])
+    return match_counts
 
-        if replace_match_index_date_with_case is not None:
-            offset_str = replace_match_index_date_with_case
-            date_offset = get_date_offset(replace_match_index_date_with_case)
 
-        if date_exclusion_variables is not None:
-            case_exclusions = date_exclusions(
-                cases, date_exclusion_variables, cases[index_date_variable]
+def sample_nearest_matches(
+    sorted_values: np.ndarray,
+    positions: np.ndarray,
+    value: Any,
+    caliper: int,
+    n_candidates: int,
+    is_eligible: Callable[[np.ndarray], np.ndarray],
+    rng: np.random.Generator,
+) -> np.ndarray:
+    """
+    Finds up to n_candidates of the positions whose sorted_values are closest to
+    value (and within the caliper) and that pass is_eligible. Walks outwards from
+    value one distance at a time; where the matches at a distance are more than
+    are still needed, a random sample of them is checked first, so the work done
+    is about n_candidates rather than the size of the caliper range. The block of
+    matches at a distance is never built: ordinals are drawn from it with
+    Generator.choice, which does not permute the whole block for small samples,
+    and mapped to the sorted array.
+    """
+    lowest = np.searchsorted(sorted_values, value - caliper, side="left")
+    highest = np.searchsorted(sorted_values, value + caliper, side="right")
+    left = right = np.searchsorted(sorted_values, value, side="left")
+    found: List[np.ndarray] = []
+    n_found = 0
+    while n_found < n_candidates and (left > lowest or right < highest):
+        ## Take the block(s) of equal values at the next closest distance
+        left_distance = value - sorted_values[left - 1] if left > lowest else np.inf
+        right_distance = sorted_values[right] - value if right < highest else np.inf
+        distance = min(left_distance, right_distance)
+        ## The block is sorted_values[left_start:left_stop] then
+        ## sorted_values[right_start:right_stop]; either part may be empty
+        left_start = left_stop = left
+        right_start = right_stop = right
+        if left_distance == distance:
+            left_start = max(
+                np.searchsorted(sorted_values, sorted_values[left - 1], side="left"),
+                lowest,
             )
-            cases = cases.loc[~case_exclusions]
-            matching_report(
-                [
-                    "Date exclusions for cases:",
-                    f"Completed {datetime.now()}",
-                    f"Cases    {len(cases)}",
-                    f"Matches  {len(matches)}",
-                ]
+            left = left_start
+        if right_distance == distance:
+            right_stop = min(
+                np.searchsorted(sorted_values, sorted_values[right], side="right"),
+                highest,
             )
+            right = right_stop
+        n_left = left_stop - left_start
+        block_size = n_left + right_stop - right_start
 
-        ## Sort cases by index date
-        cases = cases.sort_values(index_date_variable)
+        ## Check a random sample of the block, growing it until enough pass
+        needed = n_candidates - n_found
+        sample_size = min(block_size, 2 * needed)
+        while True:
+            ordinals = rng.choice(block_size, sample_size, replace=False)
+            sample = positions[
+                np.where(
+                    ordinals < n_left,
+                    left_start + ordinals,
+                    right_start + ordinals - n_left,
+                )
+            ]
+            sample = sample[is_eligible(sample)]
+            if len(sample) >= needed or sample_size == block_size:
+                break
+            sample_size = min(block_size, 2 * sample_size)
+        found.append(sample[:needed])
+        n_found += len(found[-1])
 
-        for case_id, case_row in cases.iterrows():
-            ## Get eligible matches
-            eligible_matches = get_eligible_matches(
-                case_row, matches, match_variables, indices
-            )
-            matched_rows = matches.loc[eligible_matches]
+    if not found:
+        return EMPTY_POSITIONS
+    return np.sort(np.concatenate(found))
 
-            ## Determine match index date
-            if replace_match_index_date_with_case is None:
-                index_date = matched_rows[index_date_variable]
-            else:
-                if offset_str == "no_offset":
-                    index_date = case_row[index_date_variable]
-                elif offset_str.split("_")[2] == "earlier":
-                    index_date = case_row[index_date_variable] - date_offset
-                elif offset_str.split("_")[2] == "later":
-                    index_date = case_row[index_date_variable] + date_offset
-                else:
-                    raise Exception(f"Date offset type '{offset_str}' not recognised")
-
-            ## Index date based match exclusions (faster to do this after get_eligible_matches)
+
+def optimal_match_stratum(
+    case_ids: np.ndarray,
+    case_values: Dict[str, np.ndarray],
+    case_index_dates: Optional[np.ndarray],
+    match_values: Dict[str, np.ndarray],
+    match_index_dates: np.ndarray,
+    match_priorities: np.ndarray,
+    stratum_matches: np.ndarray,
+    caliper_indices: Dict[str, Tuple[np.ndarray, np.ndarray]],
+    available: np.ndarray,
+    ledger: AssignmentLedger,
+    matches_per_case: int,
+    match_variables: Dict,
+    closest_match_variables: Optional[List[Any]] = None,
+    date_exclusion_variables: Optional[Dict[Any, Any]] = None,
+    min_matches_per_case: int = 0,
+    candidates_per_match: int = 5,
+) -> np.ndarray:
+    """
+    Optimally matches the cases of a single stratum, taking the same arguments as
+    match_stratum. Instead of picking matches case by case, the whole stratum is
+    solved as a minimum-cost assignment: each case gets matches_per_case slots,
+    each slot can take one eligible match, and the cost of a match is its summed
+    absolute difference from the case on the closest_match_variables. The number
+    of matched slots is maximised first and the total cost second.
+
+    To keep the problem sparse, each case only considers its
+    matches_per_case * candidates_per_match closest eligible matches, with ties
+    broken at random for each case so that cases with the same values spread
+    over different candidates (so match_priorities are not used). The solution is
+    optimal over those candidates.
+    With a single closest-match variable that is also a caliper variable, the
+    candidates are found with sample_nearest_matches, so the work per case does
+    not grow with the size of the stratum. Cases left with fewer than
+    min_matches_per_case matches are unmatched afterwards, and their matches are
+    not reassigned.
+    """
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import min_weight_full_bipartite_matching
+
+    n_candidates = matches_per_case * candidates_per_match
+    rng = np.random.default_rng(123)
+    case_edges, match_edges, cost_edges = [], [], []
+
+    ## With a single closest-match variable that has a caliper index, the closest
+    ## candidates can be found by walking out from the case value
+    nearest_var = None
+    if closest_match_variables is not None and len(closest_match_variables) == 1:
+        if closest_match_variables[0] in caliper_indices:
+            nearest_var = closest_match_variables[0]
+
+    for case_number in range(len(case_ids)):
+        case_row = {var: values[case_number] for var, values in case_values.items()}
+        if case_index_dates is None:
+            index_date = None
+        else:
+            index_date = case_index_dates[case_number]
+
+        def is_eligible(candidates: np.ndarray) -> np.ndarray:
+            eligible = available[candidates]
+            for match_var in caliper_indices:
+                values = widen(match_values[match_var][candidates])
+                eligible &= (
+                    abs(values - case_row[match_var]) <= match_variables[match_var]
+                )
             if date_exclusion_variables is not None:
-                exclusions = date_exclusions(
-                    matched_rows, date_exclusion_variables, index_date
+                candidate_dates = (
+                    match_index_dates[candidates] if index_date is None else index_date
                 )
-                matched_rows = matched_rows.loc[~exclusions]
+                eligible &= np.isin(
+                    candidates,
+                    exclude_by_index_date(
+                        candidates,
+                        match_values,
+                        date_exclusion_variables,
+                        candidate_dates,
+                    ),
+                )
+            return eligible
 
-            ## Pick random matches
-            matched_rows = greedily_pick_matches(
-                matches_per_case,
-                matched_rows,
+        if nearest_var is not None and not pd.isna(case_row[nearest_var]):
+            sorted_values, positions = caliper_indices[nearest_var]
+            eligible_matches = sample_nearest_matches(
+                sorted_values,
+                positions,
+                case_row[nearest_var],
+                match_variables[nearest_var],
+                n_candidates,
+                is_eligible,
+                rng,
+            )
+        else:
+            eligible_matches = get_eligible_matches(
                 case_row,
-                closest_match_variables,
+                match_values,
+                match_variables,
+                caliper_indices,
+                stratum_matches,
             )
+            eligible_matches = eligible_matches[is_eligible(eligible_matches)]
 
-            ## Report number of matches for each case
-            num_matches = len(matched_rows)
-            cases.loc[case_id, "match_counts"] = num_matches
+        costs = np.zeros(len(eligible_matches))
+        for var in closest_match_variables or []:
+            costs += abs(widen(match_values[var][eligible_matches]) - case_row[var])
+        if len(eligible_matches) > n_candidates:
+            tie_break = rng.random(len(eligible_matches))
+            closest = np.lexsort((tie_break, costs))[:n_candidates]
+            eligible_matches, costs = eligible_matches[closest], costs[closest]
 
-            ## Label matches with case ID if there are enough
-            if num_matches >= min_matches_per_case:
-                matches.loc[matched_rows, "set_id"] = case_id
+        case_edges.append(np.full(len(eligible_matches), case_number))
+        match_edges.append(eligible_matches)
+        cost_edges.append(costs)
 
-            ## Set index_date of the match where needed
-            if replace_match_index_date_with_case is not None:
-                matches.loc[matched_rows, index_date_variable] = index_date
-
-        ## Drop unmatched cases/matches
-        matched_cases = cases.loc[cases["match_counts"] >= min_matches_per_case]
-        matched_matches = matches.loc[matches["set_id"] != NOT_PREVIOUSLY_MATCHED]
-        return cases, matched_cases, matched_matches
+    match_counts = np.zeros(len(case_ids), dtype=np.int64)
+    if not case_edges:
+        return match_counts
+    case_edges = np.concatenate(case_edges)
+    match_edges = np.concatenate(match_edges)
+    cost_edges = np.concatenate(cost_edges)
+    if len(match_edges) == 0:
+        return match_counts
 
-    def frequency_matching(cases: pd.DataFrame, matches: pd.DataFrame):
-        groupby_vars = [*match_variables.keys()]
-        cases_props = cases.groupby(groupby_vars).size() / len(cases)
-        matches_props = matches.groupby(groupby_vars).size() / len(matches)
-        weights = (cases_props / matches_props).replace([np.inf, np.nan], 0)
-        weights = weights / weights.max()
+    ## One row per slot; one column per candidate match, plus one "unmatched"
+    ## column per slot that costs more than any set of real matches
+    candidates, match_columns = np.unique(match_edges, return_inverse=True)
+    n_slots = len(case_ids) * matches_per_case
+    slot = np.arange(matches_per_case)
+    rows = (case_edges[:, None] * matches_per_case + slot).ravel()
+    columns = np.repeat(match_columns, matches_per_case)
+    weights = np.repeat(cost_edges + 1, matches_per_case)
+    unmatched_cost = (weights.max() + 1) * n_slots
+    graph = csr_matrix(
+        (
+            np.concatenate([weights, np.full(n_slots, unmatched_cost)]),
+            (
+                np.concatenate([rows, np.arange(n_slots)]),
+                np.concatenate([columns, len(candidates) + np.arange(n_slots)]),
+            ),
+        ),
+        shape=(n_slots, len(candidates) + n_slots),
+    )
+    slot_rows, slot_columns = min_weight_full_bipartite_matching(graph)
 
-        def weight_groups(group):
-            return group.sample(frac=weights.loc[group.name], random_state=321)
+    is_match = slot_columns < len(candidates)
+    matched_cases = slot_rows[is_match] // matches_per_case
+    matched = candidates[slot_columns[is_match]]
+    match_counts = np.bincount(matched_cases, minlength=len(case_ids))
 
-        matched_matches = matches.groupby(groupby_vars).apply(weight_groups)
-        return cases, matched_matches
+    ## Assign matches to cases that have enough
+    keep = match_counts[matched_cases] >= min_matches_per_case
+    matched_cases, matched = matched_cases[keep], matched[keep]
+    order = np.argsort(matched_cases, kind="stable")
+    matched_cases, matched = matched_cases[order], matched[order]
+    available[matched] = False
+    ledger.extend(
+        matched,
+        case_ids[matched_cases],
+        (
+            np.full(len(matched), np.datetime64("NaT"), dtype="datetime64[ns]")
+            if case_index_dates is None
+            else case_index_dates[matched_cases].astype("datetime64[ns]")
+        ),
+    )
+    return match_counts
 
-    ## Run either individual or frequency matching
-    if matching_type == "individual":
-        cases, matched_cases, matched_matches = individual_matching(cases, matches)
-    elif matching_type == "frequency":
-        matched_cases, matched_matches = frequency_matching(cases, matches)
-    else:
-        raise ValueError("matching_type must be 'individual' or 'frequency'")
 
-    ## Describe population differences
-    scalar_comparisons = compare_populations(
-        matched_cases, matched_matches, closest_match_variables
+def whitening_transform(points: np.ndarray) -> np.ndarray:
+    """
+    Matrix that maps points (one row per point) to coordinates whose Euclidean
+    distances are Mahalanobis distances under the covariance of points.
+    Directions with no variance are dropped.
+    """
+    eigenvalues, eigenvectors = np.linalg.eigh(
+        np.atleast_2d(np.cov(points, rowvar=False))
     )
+    kept = eigenvalues > eigenvalues.max(initial=0) * 1e-12
+    return eigenvectors[:, kept] / np.sqrt(eigenvalues[kept])
 
-    matching_report(
-        [
-            "After matching:",
-            f"Completed {datetime.now()}",
-            f"Cases    {len(matched_cases)}",
-            f"Matches  {len(matched_matches)}\n",
-            "Number of available matches per case:",
-            # cases["match_counts"].value_counts().to_string(),
+
+def nearest_match_stratum(
+    case_ids: np.ndarray,
+    case_values: Dict[str, np.ndarray],
+    case_index_dates: Optional[np.ndarray],
+    match_values: Dict[str, np.ndarray],
+    match_index_dates: np.ndarray,
+    match_priorities: np.ndarray,
+    stratum_matches: np.ndarray,
+    caliper_indices: Dict[str, Tuple[np.ndarray, np.ndarray]],
+    available: np.ndarray,
+    ledger: AssignmentLedger,
+    matches_per_case: int,
+    match_variables: Dict,
+    closest_match_variables: Optional[List[Any]] = None,
+    date_exclusion_variables: Optional[Dict[Any, Any]] = None,
+    min_matches_per_case: int = 0,
+    distance_metric: str = "euclidean",
+    distance_caliper: Optional[float] = None,
+    with_replacement: bool = False,
+) -> np.ndarray:
+    """
+    Greedily matches the cases of a single stratum, in the order given, to the
+    matches nearest to them jointly on all of the closest_match_variables, taking
+    the same arguments as match_stratum. distance_metric is "euclidean", or
+    "mahalanobis" to scale by the covariance of the stratum's matches, and
+    matches further than distance_caliper are never picked. The caliper match
+    variables and date exclusions still apply.
+
+    The matches are held in a scipy cKDTree, so finding the nearest matches costs
+    a query rather than a sort over every eligible match. Matched matches stay
+    in the tree and are skipped, with the query widened until enough eligible
+    matches are found; the tree is rebuilt once half of it has been matched.
+    Equally near matches are ordered by match_priorities. with_replacement
+    works as for match_stratum. Cases or matches
+    missing any closest_match_variables are not matched.
+    """
+    from scipy.spatial import cKDTree
+
+    if not closest_match_variables:
+        raise ValueError("Nearest matching needs closest_match_variables")
+    if distance_metric not in ("euclidean", "mahalanobis"):
+        raise ValueError("distance_metric must be 'euclidean' or 'mahalanobis'")
+
+    match_counts = np.zeros(len(case_ids), dtype=np.int64)
+    coordinates = np.column_stack(
+        [
+            match_values[var][stratum_matches].astype(np.float64)
+            for var in closest_match_variables
         ]
-        + scalar_comparisons
     )
+    case_coordinates = np.column_stack(
+        [case_values[var].astype(np.float64) for var in closest_match_variables]
+    )
+    complete = ~np.isnan(coordinates).any(axis=1)
+    if distance_metric == "mahalanobis" and complete.sum() > 1:
+        whitening = whitening_transform(coordinates[complete])
+        coordinates = coordinates @ whitening
+        case_coordinates = case_coordinates @ whitening
+    upper_bound = np.inf
+    if distance_caliper is not None:
+        ## Calipers include their bound, cKDTree queries do not
+        upper_bound = np.nextafter(distance_caliper, np.inf)
+
+    risk_set = None
+    if date_exclusion_variables is not None and case_index_dates is not None:
+        risk_set = RiskSet(
+            stratum_matches, match_values, date_exclusion_variables, len(available)
+        )
 
-    ## Write to csvs
-    matched_cases.to_csv(os.path.join(output_path, f"matched_cases{output_suffix}.csv"))
-    matched_matches.to_csv(
-        os.path.join(output_path, f"matched_matches{output_suffix}.csv")
+    def build_tree() -> Tuple[Any, np.ndarray]:
+        in_tree = complete & available[stratum_matches]
+        tree = cKDTree(coordinates[in_tree]) if in_tree.any() else None
+        return tree, stratum_matches[in_tree]
+
+    tree, tree_matches = build_tree()
+    n_matched_in_tree = 0
+
+    for case_number, case_id in enumerate(case_ids):
+        case_row = {var: values[case_number] for var, values in case_values.items()}
+        case_point = case_coordinates[case_number]
+        if case_index_dates is None:
+            index_date = None
+        else:
+            index_date = case_index_dates[case_number]
+        if np.isnan(case_point).any():
+            continue
+
+        if n_matched_in_tree * 2 > len(tree_matches):
+            tree, tree_matches = build_tree()
+            n_matched_in_tree = 0
+        if tree is None:
+            continue
+
+        ## Widen the query until enough of the nearest matches are eligible
+        n_neighbours = 2 * matches_per_case
+        while True:
+            n_neighbours = min(n_neighbours, len(tree_matches))
+            distances, neighbours = tree.query(
+                case_point,
+                k=n_neighbours,
+                distance_upper_bound=upper_bound,
+            )
+            distances = np.atleast_1d(distances)
+            neighbours = np.atleast_1d(neighbours)
+            within = np.isfinite(distances)
+            candidates = tree_matches[neighbours[within]]
+            distances = distances[within]
+
+            eligible = available[candidates]
+            for match_var in caliper_indices:
+                values = widen(match_values[match_var][candidates])
+                eligible &= (
+                    abs(values - case_row[match_var]) <= match_variables[match_var]
+                )
+            candidates, distances = candidates[eligible], distances[eligible]
+            if risk_set is not None:
+                at_risk = risk_set.at_risk(candidates, index_date)
+                candidates, distances = candidates[at_risk], distances[at_risk]
+            elif date_exclusion_variables is not None:
+                kept = exclude_by_index_date(
+                    candidates,
+                    match_values,
+                    date_exclusion_variables,
+                    match_index_dates[candidates],
+                )
+                distances = distances[np.isin(candidates, kept)]
+                candidates = kept
+
+            if (
+                len(candidates) >= matches_per_case
+                or not within.all()
+                or n_neighbours == len(tree_matches)
+            ):
+                break
+            n_neighbours *= 4
+
+        order = np.lexsort((match_priorities[candidates], distances))
+        matched = candidates[order[:matches_per_case]]
+
+        ## Assign matches to the case if there are enough
+        match_counts[case_number] = len(matched)
+        if len(matched) >= min_matches_per_case:
+            if not with_replacement:
+                available[matched] = False
+                n_matched_in_tree += len(matched)
+            ledger.append(
+                matched, case_id, None if case_index_dates is None else index_date
+            )
+
+    return match_counts
+
+
+STRATUM_MATCHERS = {
+    "individual": match_stratum,
+    "optimal": optimal_match_stratum,
+    "nearest": nearest_match_stratum,
+}
+
+
+def match_stratum_task(
+    task: Dict, settings: Dict, matching_type: str = "individual"
+) -> Tuple[np.ndarray, ...]:
+    """
+    Runs match_stratum (or the stratum matcher for matching_type) on a
+    self-contained stratum, as built by
+    get_stratum_task, so that strata can be matched in separate processes. The
+    stratum gets its own availability array and ledger, and the assignments are
+    returned with their positions mapped back to the full match table, along with
+    the match count for each case.
+    """
+    ledger = AssignmentLedger()
+    match_counts = STRATUM_MATCHERS[matching_type](
+        case_ids=task["case_ids"],
+        case_values=task["case_values"],
+        case_index_dates=task["case_index_dates"],
+        match_values=task["match_values"],
+        match_index_dates=task["match_index_dates"],
+        match_priorities=task["match_priorities"],
+        stratum_matches=np.arange(len(task["match_positions"])),
+        caliper_indices=task["caliper_indices"],
+        available=task["available"],
+        ledger=ledger,
+        **settings,
+    )
+    match_positions, set_ids, index_dates = ledger.to_arrays()
+    return (
+        task["case_numbers"],
+        match_counts,
+        task["match_positions"][match_positions],
+        set_ids,
+        index_dates,
     )
-    appended = matched_cases.append(matched_matches)
-    appended.to_csv(os.path.join(output_path, f"matched_combined{output_suffix}.csv"))
 
 
-def compare_populations(
+def get_stratum_task(
+    case_numbers: np.ndarray,
+    case_ids: np.ndarray,
+    case_values: Dict[str, np.ndarray],
+    case_index_dates: Optional[np.ndarray],
+    match_values: Dict[str, np.ndarray],
+    match_index_dates: np.ndarray,
+    match_priorities: np.ndarray,
+    stratum_matches: np.ndarray,
+    caliper_indices: Dict[str, Tuple[np.ndarray, np.ndarray]],
+    available: np.ndarray,
+) -> Dict:
+    """
+    Copies out the arrays match_stratum needs for a single stratum, with the
+    stratum's matches renumbered from zero, so that it can be sent to a worker
+    process without the rest of the match table.
+    """
+    return {
+        "case_numbers": case_numbers,
+        "case_ids": case_ids,
+        "case_values": case_values,
+        "case_index_dates": case_index_dates,
+        "match_positions": stratum_matches,
+        "match_values": {
+            var: values[stratum_matches] for var, values in match_values.items()
+        },
+        "match_index_dates": match_index_dates[stratum_matches],
+        "match_priorities": match_priorities[stratum_matches],
+        "available": available[stratum_matches],
+        "caliper_indices": {
+            match_var: (sorted_values, np.searchsorted(stratum_matches, positions))
+            for match_var, (sorted_values, positions) in caliper_indices.items()
+        },
+    }
+
+
+def split_stratum(stratum: Dict, n_pieces: int) -> List[Dict]:
+    """
+    Splits the cases of a stratum (as built in match) into n_pieces strata of
+    consecutive cases sharing the same matches. Only valid when matching with
+    replacement, where cases do not compete for matches.
+    """
+    if n_pieces <= 1:
+        return [stratum]
+    pieces = []
+    for case_numbers in np.array_split(
+        np.arange(len(stratum["case_numbers"])), n_pieces
+    ):
+        pieces.append(
+            {
+                "case_numbers": stratum["case_numbers"][case_numbers],
+                "case_ids": stratum["case_ids"][case_numbers],
+                "case_values": {
+                    var: values[case_numbers]
+                    for var, values in stratum["case_values"].items()
+                },
+                "case_index_dates": (
+                    None
+                    if stratum["case_index_dates"] is None
+                    else stratum["case_index_dates"][case_numbers]
+                ),
+                "stratum_matches": stratum["stratum_matches"],
+                "caliper_indices": stratum["caliper_indices"],
+            }
+        )
+    return pieces
+
+
+def matching_fingerprint(arrays: Iterable[np.ndarray], spec: Dict) -> str:
+    """
+    Hashes the arrays and matching specification that determine the result of
+    individual matching, so that a checkpoint is only resumed by the same run.
+    """
+    key = hashlib.sha256()
+    for values in arrays:
+        key.update(np.int64(len(values)).tobytes())
+        key.update(
+            pd.util.hash_pandas_object(pd.Series(values), index=False)
+            .to_numpy()
+            .tobytes()
+        )
+    key.update(json.dumps(spec, sort_keys=True, default=str).encode())
+    return key.hexdigest()
+
+
+def save_checkpoint(
+    checkpoint_file: str,
+    fingerprint: str,
+    available: np.ndarray,
+    ledger: AssignmentLedger,
+    match_counts: np.ndarray,
+    completed: np.ndarray,
+) -> None:
+    """
+    Saves the state of individual matching after a number of completed strata:
+    the availability of each match (as bits), the ledger of assignments, the
+    match count of each case and which strata are complete. The file is written
+    under a temporary name and then moved into place, so a killed job leaves the
+    previous checkpoint intact.
+    """
+    match_positions, set_ids, index_dates = ledger.to_arrays()
+    tmp_file = f"{checkpoint_file}.tmp{os.getpid()}.npz"
+    np.savez(
+        tmp_file,
+        fingerprint=np.array(fingerprint),
+        n_matches=np.array(len(available)),
+        available=np.packbits(available),
+        match_positions=match_positions,
+        set_ids=set_ids,
+        index_dates=index_dates.astype("datetime64[ns]"),
+        match_counts=match_counts,
+        completed=completed,
+    )
+    os.replace(tmp_file, checkpoint_file)
+
+
+def load_checkpoint(
+    checkpoint_file: str, fingerprint: str
+) -> Optional[Tuple[np.ndarray, AssignmentLedger, np.ndarray, np.ndarray]]:
+    """
+    Loads a checkpoint saved by save_checkpoint, returning the availability,
+    ledger, match counts and completed strata, or None if there is no
+    checkpoint for a run with this fingerprint.
+    """
+    if not os.path.isfile(checkpoint_file):
+        return None
+    with np.load(checkpoint_file, allow_pickle=False) as checkpoint:
+        if str(checkpoint["fingerprint"]) != fingerprint:
+            return None
+        available = np.unpackbits(
+            checkpoint["available"], count=int(checkpoint["n_matches"])
+        ).astype(bool)
+        ledger = AssignmentLedger()
+        if len(checkpoint["match_positions"]):
+            ledger.extend(
+                checkpoint["match_positions"],
+                checkpoint["set_ids"],
+                checkpoint["index_dates"],
+            )
+        return (
+            available,
+            ledger,
+            checkpoint["match_counts"],
+            checkpoint["completed"],
+        )
+
+
+def ledger_to_matches(
+    matches: pd.DataFrame,
+    ledger: AssignmentLedger,
+    index_date_variable: Optional[str] = None,
+    with_replacement: bool = False,
+) -> pd.DataFrame:
+    """
+    Gathers the assigned matches from the match table in one operation, in match
+    table order, and sets their set_id (and, if index_date_variable is given, their
+    index date) from the ledger.
+
+    When matching with_replacement, a match used by several cases has one row per
+    case, and match_uses records how many cases used it, as the weight of that
+    control's usage.
+    """
+    match_positions, set_ids, index_dates = ledger.to_arrays()
+    order = np.argsort(match_positions, kind="stable")
+    matched_matches = matches.iloc[match_positions[order]].copy()
+    matched_matches["set_id"] = set_ids[order]
+    if index_date_variable is not None:
+        matched_matches[index_date_variable] = index_dates[order]
+    if with_replacement:
+        uses = np.bincount(match_positions, minlength=len(matches))
+        matched_matches["match_uses"] = uses[match_positions[order]]
+    return matched_matches
+
+
+def get_date_offset(offset_str: str) -> Optional[pd.DataFrame]:
+    """
+    Parses the string given by replace_match_index_date_with_case
+    to determine the unit and length of offset.
+    Returns a pr.DateOffset of the appropriate length.
+    """
+    if offset_str == "no_offset":
+        offset = None
+    else:
+        length = int(offset_str.split("_")[0])
+        unit = offset_str.split("_")[1]
+        if unit in ("year", "years"):
+            offset = pd.DateOffset(years=length)
+        elif unit in ("month", "months"):
+            offset = pd.DateOffset(months=length)
+        elif unit in ("day", "days"):
+            offset = pd.DateOffset(days=length)
+        else:
+            raise Exception(f"Date offset '{unit}' not implemented")
+    return offset
+
+
+def get_match_index_dates(case_index_dates: pd.Series, offset_str: str) -> np.ndarray:
+    """
+    Applies the offset given by replace_match_index_date_with_case to the case
+    index dates, to give the index date of each case's matches.
+    """
+    if offset_str == "no_offset":
+        return case_index_dates.to_numpy()
+    date_offset = get_date_offset(offset_str)
+    if offset_str.split("_")[2] == "earlier":
+        return (case_index_dates - date_offset).to_numpy()
+    elif offset_str.split("_")[2] == "later":
+        return (case_index_dates + date_offset).to_numpy()
+    else:
+        raise Exception(f"Date offset type '{offset_str}' not recognised")
+
+
+def assign_index_dates(
+    matches: pd.DataFrame,
+    index_date_variable: str,
+    start: Optional[str] = None,
+    end: Optional[str] = None,
+    case_index_dates: Optional[Union[pd.Series, np.ndarray]] = None,
+    seed: int = 123,
+    chunksize: Optional[int] = None,
+) -> None:
+    """
+    Gives every match an index date, drawn with a seeded generator either
+    uniformly from the days from start to end (inclusive), or if case_index_dates
+    is given, from the cases' index dates so that the matches share their
+    distribution. The dates are written to matches[index_date_variable] in place,
+    as datetime64.
+
+    If chunksize is given, the dates of each chunksize rows are drawn with seed
+    plus the number of the chunk, as they are when each chunk of a streamed match
+    csv is given its dates as it is read.
+    """
+    if case_index_dates is None:
+        if start is None or end is None:
+            raise ValueError("start and end are needed without case_index_dates")
+        first_day = np.datetime64(start, "D")
+        n_days = (np.datetime64(end, "D") - first_day).astype(np.int64) + 1
+
+        def draw(rng: np.random.Generator, n: int) -> np.ndarray:
+            return first_day + rng.integers(0, n_days, n).astype("timedelta64[D]")
+
+    else:
+        case_dates = pd.to_datetime(pd.Series(case_index_dates)).dropna().to_numpy()
+        if len(case_dates) == 0:
+            raise ValueError("case_index_dates has no dates to draw from")
+
+        def draw(rng: np.random.Generator, n: int) -> np.ndarray:
+            return case_dates[rng.integers(0, len(case_dates), n)]
+
+    if chunksize is None:
+        dates = draw(np.random.default_rng(seed), len(matches))
+    else:
+        chunk_starts = range(0, max(len(matches), 1), chunksize)
+        dates = np.concatenate(
+            [
+                draw(
+                    np.random.default_rng(seed + number),
+                    min(chunksize, len(matches) - chunk_start),
+                )
+                for number, chunk_start in enumerate(chunk_starts)
+            ]
+        )
+    matches[index_date_variable] = dates.astype("datetime64[ns]")
+
+
+def get_group_codes(
+    frame: pd.DataFrame, groupby_vars: List[str], group_numbers: Dict[Tuple, int]
+) -> np.ndarray:
+    """
+    Returns the group code of each row of frame, from the combination of its
+    groupby_vars values. group_numbers maps each combination to its code, and new
+    combinations are numbered in the order they are first seen, so frames (or
+    chunks of a frame) coded with the same group_numbers share codes. Rows with a
+    missing value in any of groupby_vars get -1.
+    """
+    keys = frame[groupby_vars]
+    local_codes = (
+        keys.groupby(groupby_vars, observed=True, sort=False)
+        .ngroup()
+        .fillna(-1)
+        .to_numpy(dtype=np.int64)
+    )
+    grouped = np.flatnonzero(local_codes >= 0)
+    local_groups, first_rows = np.unique(local_codes[grouped], return_index=True)
+    first_rows = np.sort(grouped[first_rows])
+
+    global_codes = np.empty(len(local_groups), dtype=np.int64)
+    for local_code, key in zip(
+        local_codes[first_rows],
+        keys.iloc[first_rows].itertuples(index=False, name=None),
+    ):
+        global_codes[local_code] = group_numbers.setdefault(key, len(group_numbers))
+    codes = np.full(len(frame), -1, dtype=np.int64)
+    codes[grouped] = global_codes[local_codes[grouped]]
+    return codes
+
+
+def frequency_sample_sizes(
+    case_counts: np.ndarray, match_counts: np.ndarray, n_cases: int, n_matches: int
+) -> np.ndarray:
+    """
+    Number of matches to sample from each group so that the matches have the
+    same distribution over the groups as the cases. Each group is weighted by
+    its share of the cases over its share of the matches, scaled so the largest
+    weight is 1, and the sample is the weight times the group size, rounded half
+    to even as DataFrame.sample(frac=...) does.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        weights = (case_counts / n_cases) / (match_counts / n_matches)
+    weights[~np.isfinite(weights)] = 0
+    if not weights.any():
+        return np.zeros(len(weights), dtype=np.int64)
+    weights = weights / weights.max()
+    return np.round(weights * match_counts).astype(np.int64)
+
+
+def sample_group_ordinals(
+    group_sizes: np.ndarray, sample_sizes: np.ndarray, seed: int = 321
+) -> np.ndarray:
+    """
+    Samples without replacement sample_sizes[g] of the group_sizes[g] rows of each
+    group g, all with one seeded generator. Rows are laid out group by group, in
+    their order within the group, and the result is the sorted places of the
+    sampled rows in that layout. Each group's sample is drawn on its own, so
+    nothing the length of the whole layout is allocated.
+    """
+    rng = np.random.default_rng(seed)
+    group_starts = np.cumsum(group_sizes) - group_sizes
+    sampled = [EMPTY_POSITIONS]
+    for group_start, group_size, sample_size in zip(
+        group_starts, group_sizes, sample_sizes
+    ):
+        if sample_size == 0:
+            continue
+        if sample_size >= group_size:
+            ordinals = np.arange(group_size)
+        else:
+            ordinals = np.sort(rng.choice(group_size, sample_size, replace=False))
+        sampled.append(group_start + ordinals)
+    return np.concatenate(sampled).astype(np.intp, copy=False)
+
+
+def stream_frequency_matches(
+    read_matches: Callable[[], Iterable[pd.DataFrame]],
+    cases: pd.DataFrame,
+    groupby_vars: List[str],
+    seed: int = 321,
+) -> Tuple[int, Iterator[pd.DataFrame]]:
+    """
+    Frequency matching for match populations too large to hold in memory.
+    read_matches is called twice and should read the matches in chunks each time.
+    The first pass counts the matches in each group and is run straight away; the
+    second pass is returned as an iterator of the sampled rows of each chunk,
+    which can be written out as it goes. Returns the number of matches and that
+    iterator. The sample is the same as frequency matching of the whole table.
+    """
+    group_numbers: Dict[Tuple, int] = {}
+    case_codes = get_group_codes(cases, groupby_vars, group_numbers)
+
+    ## First pass: count the matches in each group
+    n_matches = 0
+    match_counts = np.zeros(0, dtype=np.int64)
+    for chunk in read_matches():
+        codes = get_group_codes(chunk, groupby_vars, group_numbers)
+        chunk_counts = np.bincount(codes[codes >= 0], minlength=len(group_numbers))
+        chunk_counts[: len(match_counts)] += match_counts
+        match_counts = chunk_counts
+        n_matches += len(chunk)
+    n_groups = len(group_numbers)
+    match_counts = np.pad(match_counts, (0, n_groups - len(match_counts)))
+    sample_sizes = frequency_sample_sizes(
+        np.bincount(case_codes[case_codes >= 0], minlength=n_groups),
+        match_counts,
+        len(cases),
+        n_matches,
+    )
+    sampled = sample_group_ordinals(match_counts, sample_sizes, seed)
+    group_starts = np.cumsum(match_counts) - match_counts
+
+    ## Second pass: keep the rows whose place in their group was sampled
+    def sampled_chunks() -> Iterator[pd.DataFrame]:
+        seen = np.zeros(n_groups, dtype=np.int64)
+        for chunk in read_matches():
+            codes = get_group_codes(chunk, groupby_vars, group_numbers)
+            grouped = np.flatnonzero(codes >= 0)
+            codes = codes[grouped]
+            ordinals = pd.Series(codes).groupby(codes).cumcount().to_numpy()
+            places = group_starts[codes] + seen[codes] + ordinals
+            found = np.searchsorted(sampled, places)
+            keep = found < len(sampled)
+            keep[keep] = sampled[found[keep]] == places[keep]
+            seen += np.bincount(codes, minlength=n_groups)
+            yield chunk.iloc[grouped[keep]]
+
+    return n_matches, sampled_chunks()
+
+
+OUTPUT_FORMATS = ("csv", "csv.gz", "csv.zst", "parquet", "feather")
+OUTPUT_TABLES = ("cases", "matches", "combined", "membership")
+
+
+def open_output(file_path: str, output_format: str) -> IO:
+    """
+    Opens a text handle for writing a csv output, compressing it if the format
+    asks for it. zstd compression needs the zstandard package.
+    """
+    if output_format == "csv.gz":
+        return gzip.open(file_path, "wt", newline="")
+    if output_format == "csv.zst":
+        try:
+            import zstandard
+        except ImportError as error:
+            raise ImportError("output_format 'csv.zst' needs zstandard") from error
+        compressor = zstandard.ZstdCompressor().stream_writer(open(file_path, "wb"))
+        return io.TextIOWrapper(compressor, encoding="utf-8", newline="")
+    return open(file_path, "w", newline="")
+
+
+class TableWriter:
+    """
+    Writes tables one after the other as a single output with the given columns.
+    csv outputs are streamed table by table into one (optionally compressed)
+    file, so the tables are never concatenated in memory; columnar formats need
+    pyarrow and are written from one concatenated table on close.
+    """
+
+    def __init__(self, file_path: str, output_format: str, columns: List[str]):
+        self.file_path = file_path
+        self.output_format = output_format
+        self.columns = columns
+        self.tables: List[pd.DataFrame] = []
+        self.header = True
+        self.output_file = None
+        if output_format not in ("parquet", "feather"):
+            self.output_file = open_output(file_path, output_format)
+
+    def write(self, table: pd.DataFrame) -> None:
+        if list(table.columns) != self.columns:
+            table = table.reindex(columns=self.columns)
+        if self.output_file is None:
+            self.tables.append(table)
+        else:
+            table.to_csv(self.output_file, header=self.header)
+            self.header = False
+
+    def close(self) -> None:
+        if self.output_file is not None:
+            self.output_file.close()
+            return
+        table = pd.concat(self.tables) if len(self.tables) > 1 else self.tables[0]
+        if self.output_format == "parquet":
+            table.to_parquet(self.file_path)
+        else:
+            table.reset_index().to_feather(self.file_path)
+
+
+def write_matched(
+    matched_cases: pd.DataFrame,
+    matched_matches: Union[pd.DataFrame, Iterable[pd.DataFrame]],
+    output_path: str,
+    output_suffix: str = "",
+    output_format: str = "csv",
+    output_tables: Tuple[str, ...] = ("combined", "membership"),
+) -> None:
+    """
+    Writes the requested output_tables to output_path in output_format (one of
+    OUTPUT_FORMATS):
+    - combined - the matched cases followed by the matched matches
+    - membership - just patient_id, set_id and role (case or match) for everyone
+      in the combined table
+    - cases, matches - the matched cases or matched matches on their own
+
+    matched_matches can also be an iterable of chunks with the same columns, as
+    from stream_frequency_matches; each chunk is written to every table before
+    the next is read.
+    """
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"output_format must be one of {OUTPUT_FORMATS}")
+    for table_name in output_tables:
+        if table_name not in OUTPUT_TABLES:
+            raise ValueError(f"output_tables must be from {OUTPUT_TABLES}")
+
+    os.makedirs(output_path, exist_ok=True)
+
+    if isinstance(matched_matches, pd.DataFrame):
+        matched_matches = [matched_matches]
+    match_chunks = iter(matched_matches)
+    first_chunk = next(match_chunks, pd.DataFrame())
+    match_chunks = itertools.chain([first_chunk], match_chunks)
+
+    def membership(table: pd.DataFrame, role: str) -> pd.DataFrame:
+        return pd.DataFrame(
+            {
+                "set_id": table["set_id"] if "set_id" in table else np.nan,
+                "role": role,
+            },
+            index=table.index,
+        )
+
+    table_columns = {
+        "cases": [*matched_cases.columns],
+        "matches": [*first_chunk.columns],
+        "combined": [*dict.fromkeys([*matched_cases, *first_chunk])],
+        "membership": ["set_id", "role"],
+    }
+    writers = {
+        table_name: TableWriter(
+            os.path.join(
+                output_path, f"matched_{table_name}{output_suffix}.{output_format}"
+            ),
+            output_format,
+            table_columns[table_name],
+        )
+        for table_name in output_tables
+    }
+    for table_name, writer in writers.items():
+        if table_name in ("cases", "combined"):
+            writer.write(matched_cases)
+        elif table_name == "membership":
+            writer.write(membership(matched_cases, "case"))
+    for chunk in match_chunks:
+        for table_name, writer in writers.items():
+            if table_name in ("matches", "combined"):
+                writer.write(chunk)
+            elif table_name == "membership":
+                writer.write(membership(chunk, "match"))
+    for writer in writers.values():
+        writer.close()
+
+
+def peak_rss_mb() -> Optional[Dict[str, float]]:
+    """
+    Peak resident memory so far of this process and of its finished child
+    processes (such as matching workers), in MB. Returns None where the
+    resource module is not available.
+    """
+    if resource is None:
+        return None
+    ## ru_maxrss is in bytes on macOS and kB elsewhere
+    scale = 1024**2 if sys.platform == "darwin" else 1024
+    return {
+        "self": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / scale,
+        "children": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / scale,
+    }
+
+
+def cpu_seconds() -> float:
+    """
+    CPU time used so far by this process and its finished child processes.
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def json_default(value: Any) -> Any:
+    if isinstance(value, np.generic):
+        return value.item()
+    return str(value)
+
+
+class MatchingTelemetry:
+    """
+    Records each phase of a matching run (wall time, CPU time, peak memory and
+    whatever row counts the phase adds) in records and, if file_path is given,
+    appends it as one JSON line to file_path, so that runs and years can be
+    compared. run_fields are added to every record.
+    """
+
+    def __init__(self, file_path: Optional[str] = None, **run_fields):
+        self.file_path = file_path
+        self.run_fields = {"run_started": datetime.now().isoformat(), **run_fields}
+        self.records: List[Dict] = []
+
+    @contextlib.contextmanager
+    def phase(self, name: str, **fields) -> Iterator[Dict]:
+        """
+        Times the body of the with block. The record is yielded so that the
+        block can add fields to it, such as rows_out.
+        """
+        record = {"phase": name, **fields}
+        wall_start, cpu_start = time.perf_counter(), cpu_seconds()
+        yield record
+        record["wall_seconds"] = time.perf_counter() - wall_start
+        record["cpu_seconds"] = cpu_seconds() - cpu_start
+        record["peak_rss_mb"] = peak_rss_mb()
+        self.records.append({**self.run_fields, **record})
+
+        if self.file_path is not None:
+            os.makedirs(os.path.dirname(self.file_path) or ".", exist_ok=True)
+            with open(self.file_path, "a") as telemetry_file:
+                telemetry_file.write(
+                    json.dumps(self.records[-1], default=json_default) + "\n"
+                )
+
+
+class MatchingReport:
+    """
+    The report of a matching run: the lines describing each step, which are
+    printed (and, if file_path is given, appended to it) as they are added, the
+    balance table of the matched cases and matches, and the telemetry records of
+    each phase. Any existing report at file_path is replaced.
+    """
+
+    def __init__(self, file_path: Optional[str] = None):
+        self.file_path = file_path
+        self.lines: List[str] = []
+        self.balance: Optional[pd.DataFrame] = None
+        self.telemetry: List[Dict] = []
+        if file_path is not None and os.path.isfile(file_path):
+            os.remove(file_path)
+
+    def add(self, text_to_write: List) -> None:
+        for line in text_to_write:
+            self.lines.append(f"{line}")
+            print(line)
+        self.lines.append("")
+        print("\n")
+        if self.file_path is not None:
+            os.makedirs(os.path.dirname(self.file_path) or ".", exist_ok=True)
+            with open(self.file_path, "a") as txt:
+                for line in text_to_write:
+                    txt.writelines(f"{line}\n")
+                txt.writelines("\n")
+
+    def __str__(self) -> str:
+        return "\n".join(self.lines)
+
+
+def describe_balance(
+    report: MatchingReport,
     matched_cases: pd.DataFrame,
     matched_matches: pd.DataFrame,
-    closest_match_variables: Optional[List[Any]],
+    variables: List[str],
+) -> List[str]:
+    """
+    Adds the balance of matched_matches against matched_cases on variables to
+    the report, and returns it as report lines.
+    """
+    report.balance = balance_table(matched_cases, matched_matches, variables)
+    return ["\nBalance:", report.balance.to_string(index=False)]
+
+
+def check_match_settings(
+    matching_type: str,
+    matches_per_case: int,
+    min_matches_per_case: int,
+    with_replacement: bool,
+) -> None:
+    if matching_type not in STRATUM_MATCHERS and matching_type != "frequency":
+        raise ValueError(
+            "matching_type must be 'individual', 'optimal', 'nearest' or 'frequency'"
+        )
+    if min_matches_per_case > matches_per_case:
+        raise ValueError("min_matches_per_case cannot be greater than matches_per_case")
+    if with_replacement and matching_type not in ("individual", "nearest"):
+        raise ValueError(
+            "with_replacement is only possible for 'individual' or 'nearest' matching"
+        )
+
+
+def prepare_frame(
+    frame: Any, match_variables: Dict, date_variables: List[str]
 ) -> pd.DataFrame:
     """
-    Takes the list of closest_match_variables and describes each of them for the matched
-    case and matched control population, so that their similarity can be checked.
-    Returns a list strings corresponding to the rows of the describe() test_data, to be
-    passed to matching_report(). Returns empty list if no closest_match_variables are
-    specified.
+    Puts a case or match table given to match_frames (a DataFrame, or an Arrow
+    table) in the form import_csvs gives: indexed by patient_id, with categorical
+    match variables as categories, date_variables as datetime64, and month_only
+    variables' {var}_m variables added. The caller's frame is not changed.
     """
-    scalar_comparisons = []
-    if closest_match_variables is not None:
-        for var in closest_match_variables:
-            scalar_comparisons.extend(
+    if hasattr(frame, "to_pandas"):
+        frame = frame.to_pandas()
+    if "patient_id" in frame.columns:
+        frame = frame.set_index("patient_id")
+    else:
+        frame = frame.copy(deep=False)
+    for var, match_type in match_variables.items():
+        if (
+            match_type == "category"
+            and var in frame
+            and not isinstance(frame[var].dtype, pd.CategoricalDtype)
+        ):
+            frame[var] = frame[var].astype("category")
+    for var in date_variables:
+        if var in frame and not pd.api.types.is_datetime64_any_dtype(frame[var]):
+            frame[var] = pd.to_datetime(frame[var])
+    add_month_only_variables(frame, match_variables)
+    return frame
+
+
+def match_frames(
+    cases: pd.DataFrame,
+    matches: pd.DataFrame,
+    matches_per_case: int,
+    match_variables: Dict,
+    index_date_variable: str,
+    matching_type: str = "individual",
+    closest_match_variables: Optional[List[Any]] = None,
+    date_exclusion_variables: Optional[Dict[Any, Any]] = None,
+    min_matches_per_case: int = 0,
+    replace_match_index_date_with_case: Optional[str] = None,
+    indicator_variable_name: str = "case",
+    drop_cases_from_matches: bool = False,
+    workers: int = 1,
+    optimal_candidates_per_match: int = 5,
+    distance_metric: str = "euclidean",
+    distance_caliper: Optional[float] = None,
+    balance_variables: Optional[List[str]] = None,
+    with_replacement: bool = False,
+    checkpoint_file: Optional[str] = None,
+    checkpoint_seconds: float = 600,
+    report: Optional[MatchingReport] = None,
+    telemetry: Optional[MatchingTelemetry] = None,
+    indices: Optional[Dict] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame, MatchingReport]:
+    """
+    Matches the cases to the matches in memory, and returns the matched cases,
+    the matched matches and the report of the run. cases and matches are
+    DataFrames (or Arrow tables) with a patient_id column or index, and the
+    matching options are as for match, which reads its csvs and writes its
+    outputs around this.
+
+    A report (and telemetry) can be given to add to, such as one that writes to
+    a file. indices are precalculated indices of matches, as from
+    get_match_pool; the categories of matches come first when they are shared
+    with cases (see share_categories), so the indices keep their codes.
+    """
+    check_match_settings(
+        matching_type, matches_per_case, min_matches_per_case, with_replacement
+    )
+    if report is None:
+        report = MatchingReport()
+        report.add([f"Matching started at: {datetime.now()}"])
+    if telemetry is None:
+        telemetry = MatchingTelemetry(matching_type=matching_type, workers=workers)
+    report.telemetry = telemetry.records
+
+    match_variables = copy.deepcopy(match_variables)
+    exclusion_vars = [*(date_exclusion_variables or {})]
+    cases = prepare_frame(
+        cases, match_variables, [*exclusion_vars, index_date_variable]
+    )
+    if replace_match_index_date_with_case is None:
+        exclusion_vars.append(index_date_variable)
+    matches = prepare_frame(matches, match_variables, exclusion_vars)
+    replace_month_only_variables(match_variables)
+    share_categories([matches, cases], match_variables)
+
+    ## Drop cases from match population if specified
+    unavailable = None
+    n_matches = len(matches)
+    with telemetry.phase("drop_cases", rows_in={"matches": n_matches}) as phase:
+        if drop_cases_from_matches:
+            ## Flag rather than drop them, so the match table is not copied
+            unavailable = matches.index.isin(cases.index)
+            n_matches -= unavailable.sum()
+        phase["rows_out"] = {"matches": n_matches}
+
+    report.add(
+        [
+            "Dropping cases from matches:",
+            f"Completed {datetime.now()}",
+            f"Cases    {len(cases)}",
+            f"Matches  {n_matches}",
+        ]
+    )
+
+    def individual_matching(
+        cases: pd.DataFrame,
+        matches: pd.DataFrame,
+        indices: Optional[Dict] = None,
+        unavailable: Optional[np.ndarray] = None,
+    ):
+        ## Add set_id variable
+        cases, matches = add_variables(cases, matches, indicator_variable_name)
+
+        with telemetry.phase("index", cached=indices is not None):
+            if indices is None:
+                indices = pre_calculate_indices(cases, matches, match_variables)
+        report.add([f"Completed pre-calculating indices at {datetime.now()}"])
+
+        if date_exclusion_variables is not None:
+            with telemetry.phase("exclusions", rows_in={"cases": len(cases)}) as phase:
+                case_exclusions = date_exclusions(
+                    cases, date_exclusion_variables, cases[index_date_variable]
+                )
+                cases = cases.loc[~case_exclusions]
+                phase["rows_out"] = {"cases": len(cases)}
+            report.add(
                 [
-                    f"\n{var} comparison:",
-                    "Cases:",
-                    matched_cases[var].describe().to_string(),
-                    "Matches:",
-                    matched_matches[var].describe().to_string(),
+                    "Date exclusions for cases:",
+                    f"Completed {datetime.now()}",
+                    f"Cases    {len(cases)}",
+                    f"Matches  {len(matches)}",
                 ]
             )
-    return scalar_comparisons
+
+        ## Sort cases by index date
+        cases = cases.sort_values(index_date_variable)
+
+        ## Determine match index dates
+        if replace_match_index_date_with_case is None:
+            case_index_dates = None
+        else:
+            case_index_dates = get_match_index_dates(
+                cases[index_date_variable], replace_match_index_date_with_case
+            )
+
+        categorical_vars, caliper_vars = split_match_variables(match_variables)
+        value_vars = [*caliper_vars, *(closest_match_variables or [])]
+
+        ## Group cases by stratum (their tuple of category codes), keeping them
+        ## in index date order
+        case_strata: Dict = {}
+        if categorical_vars:
+            for case_number, stratum in enumerate(
+                stratum_codes(cases, categorical_vars).itertuples(
+                    index=False, name=None
+                )
+            ):
+                case_strata.setdefault(stratum, []).append(case_number)
+        else:
+            case_strata[()] = list(range(len(cases)))
+
+        available = np.ones(len(matches), dtype=bool)
+        if unavailable is not None:
+            available[unavailable] = False
+        ledger = AssignmentLedger()
+        match_counts = np.zeros(len(cases), dtype=np.int64)
+        match_values = {var: matches[var].to_numpy() for var in value_vars}
+        if case_index_dates is None:
+            match_index_dates = matches[index_date_variable].to_numpy()
+        else:
+            match_index_dates = np.full(
+                len(matches), np.datetime64("NaT"), dtype="datetime64[ns]"
+            )
+        if date_exclusion_variables is None:
+            match_date_exclusions = None
+        else:
+            exclusion_dates, match_date_exclusions = combine_date_exclusions(
+                matches, date_exclusion_variables
+            )
+            match_values.update(exclusion_dates)
+            if case_index_dates is None:
+                ## Matches keep their own index dates, so whether they are
+                ## excluded does not depend on the case
+                all_matches = np.arange(len(matches))
+                not_excluded = np.zeros(len(matches), dtype=bool)
+                not_excluded[
+                    exclude_by_index_date(
+                        all_matches,
+                        match_values,
+                        match_date_exclusions,
+                        match_index_dates,
+                    )
+                ] = True
+                available &= not_excluded
+                match_date_exclusions = None
+        match_priorities = get_match_priorities(matches.index.to_numpy())
+
+        settings = {
+            "matches_per_case": matches_per_case,
+            "match_variables": match_variables,
+            "closest_match_variables": closest_match_variables,
+            "date_exclusion_variables": match_date_exclusions,
+            "min_matches_per_case": min_matches_per_case,
+        }
+        if matching_type == "optimal":
+            settings["candidates_per_match"] = optimal_candidates_per_match
+        elif matching_type == "nearest":
+            settings["distance_metric"] = distance_metric
+            settings["distance_caliper"] = distance_caliper
+        if with_replacement:
+            settings["with_replacement"] = True
+        strata = []
+        for stratum, case_numbers in case_strata.items():
+            stratum_matches = intersect_buckets(
+                [
+                    indices[match_var].get(value, EMPTY_POSITIONS)
+                    for match_var, value in zip(categorical_vars, stratum)
+                ],
+                len(matches),
+            )
+            caliper_indices = {
+                match_var: indices[match_var].get(
+                    stratum, (EMPTY_POSITIONS, EMPTY_POSITIONS)
+                )
+                for match_var in caliper_vars
+            }
+            case_numbers = np.array(case_numbers)
+            strata.append(
+                {
+                    "case_numbers": case_numbers,
+                    "case_ids": cases.index.to_numpy()[case_numbers],
+                    "case_values": {
+                        var: widen(cases[var].to_numpy()[case_numbers])
+                        for var in value_vars
+                    },
+                    "case_index_dates": (
+                        None
+                        if case_index_dates is None
+                        else case_index_dates[case_numbers]
+                    ),
+                    "stratum_matches": stratum_matches,
+                    "caliper_indices": caliper_indices,
+                }
+            )
+
+        ## Matches stay available when matching with replacement, so the cases of
+        ## a stratum can be split between workers without changing the result
+        if with_replacement and workers > 1:
+            strata = [
+                piece
+                for stratum in strata
+                for piece in split_stratum(
+                    stratum, -(-len(stratum["case_numbers"]) // REPLACEMENT_CASES)
+                )
+            ]
+
+        ## Resume from a checkpoint of this same run, if there is one. Strata stay
+        ## in the order they were built (workers only change the order they are
+        ## sent in), so serial and parallel runs can resume each other's
+        ## checkpoints, unless strata were split between workers
+        completed = np.zeros(len(strata), dtype=bool)
+        if checkpoint_file is not None:
+            fingerprint = matching_fingerprint(
+                [
+                    matches.index.to_numpy(),
+                    available,
+                    match_index_dates,
+                    match_priorities,
+                    *[match_values[var] for var in sorted(match_values)],
+                    cases.index.to_numpy(),
+                    cases[index_date_variable].to_numpy(),
+                    *[
+                        values
+                        for stratum in strata
+                        for values in (
+                            stratum["case_numbers"],
+                            stratum["stratum_matches"],
+                            *[
+                                stratum["case_values"][var]
+                                for var in sorted(stratum["case_values"])
+                            ],
+                            *(
+                                []
+                                if stratum["case_index_dates"] is None
+                                else [stratum["case_index_dates"]]
+                            ),
+                        )
+                    ],
+                ],
+                {"matching_type": matching_type, **settings},
+            )
+            checkpoint = load_checkpoint(checkpoint_file, fingerprint)
+            if checkpoint is not None:
+                available, ledger, match_counts, completed = checkpoint
+                report.add(
+                    [
+                        f"Resumed from checkpoint at {datetime.now()}:",
+                        f"{completed.sum()} of {len(strata)} strata already matched",
+                    ]
+                )
+            os.makedirs(os.path.dirname(checkpoint_file) or ".", exist_ok=True)
+        last_checkpoint = time.monotonic()
+
+        def stratum_matched(stratum_number: int) -> None:
+            ## Checkpoint at most every checkpoint_seconds, between strata
+            nonlocal last_checkpoint
+            completed[stratum_number] = True
+            if (
+                checkpoint_file is not None
+                and time.monotonic() - last_checkpoint >= checkpoint_seconds
+            ):
+                save_checkpoint(
+                    checkpoint_file,
+                    fingerprint,
+                    available,
+                    ledger,
+                    match_counts,
+                    completed,
+                )
+                last_checkpoint = time.monotonic()
+
+        ## Size of the stratum each case is matched within, before calipers
+        stratum_sizes = np.array(
+            [len(stratum["stratum_matches"]) for stratum in strata], dtype=np.int64
+        )
+        stratum_cases = np.array(
+            [len(stratum["case_numbers"]) for stratum in strata], dtype=np.int64
+        )
+        remaining = np.flatnonzero(~completed)
+        if workers > 1 and len(remaining) > 1:
+            ## Send the largest strata first so that the pool stays busy
+            remaining = remaining[
+                np.argsort(-(stratum_sizes * stratum_cases)[remaining], kind="stable")
+            ]
+        with telemetry.phase(
+            "matching",
+            rows_in={"cases": len(cases), "matches": int(available.sum())},
+            strata=len(strata),
+            resumed_strata=int(completed.sum()),
+            largest_stratum_matches=int(stratum_sizes.max(initial=0)),
+            mean_stratum_matches_per_case=(
+                float((stratum_sizes * stratum_cases).sum() / max(len(cases), 1))
+            ),
+        ) as phase:
+            if workers > 1 and len(remaining) > 1:
+                tasks = (
+                    get_stratum_task(
+                        match_values=match_values,
+                        match_index_dates=match_index_dates,
+                        match_priorities=match_priorities,
+                        available=available,
+                        **strata[stratum_number],
+                    )
+                    for stratum_number in remaining
+                )
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    for stratum_number, (
+                        case_numbers,
+                        stratum_counts,
+                        match_positions,
+                        set_ids,
+                        index_dates,
+                    ) in zip(
+                        remaining,
+                        executor.map(
+                            match_stratum_task,
+                            tasks,
+                            itertools.repeat(settings),
+                            itertools.repeat(matching_type),
+                        ),
+                    ):
+                        match_counts[case_numbers] = stratum_counts
+                        ledger.extend(match_positions, set_ids, index_dates)
+                        if not with_replacement:
+                            available[match_positions] = False
+                        stratum_matched(stratum_number)
+            else:
+                for stratum_number in remaining:
+                    stratum = strata[stratum_number]
+                    case_numbers = stratum.pop("case_numbers")
+                    match_counts[case_numbers] = STRATUM_MATCHERS[matching_type](
+                        match_values=match_values,
+                        match_index_dates=match_index_dates,
+                        match_priorities=match_priorities,
+                        available=available,
+                        ledger=ledger,
+                        **stratum,
+                        **settings,
+                    )
+                    stratum_matched(stratum_number)
+            phase["rows_out"] = {
+                "cases": int((match_counts >= min_matches_per_case).sum()),
+                "matches": sum(len(matched) for matched in ledger.match_positions),
+            }
+
+        if checkpoint_file is not None and os.path.isfile(checkpoint_file):
+            os.remove(checkpoint_file)
+
+        ## Build the matched tables from the ledger
+        cases["match_counts"] = match_counts
+        matched_cases = cases.loc[cases["match_counts"] >= min_matches_per_case]
+        matched_matches = ledger_to_matches(
+            matches,
+            ledger,
+            index_date_variable if case_index_dates is not None else None,
+            with_replacement,
+        )
+        return cases, matched_cases, matched_matches
+
+    def frequency_matching(
+        cases: pd.DataFrame,
+        matches: pd.DataFrame,
+        unavailable: Optional[np.ndarray] = None,
+    ):
+        groupby_vars = [*match_variables.keys()]
+        ## Group and sample on positions and the groupby columns only, and
+        ## gather the full rows once for the sampled matches
+        if unavailable is None:
+            positions = np.arange(len(matches))
+        else:
+            positions = np.flatnonzero(~unavailable)
+        group_numbers: Dict[Tuple, int] = {}
+        case_codes = get_group_codes(cases, groupby_vars, group_numbers)
+        match_codes = get_group_codes(
+            matches[groupby_vars].iloc[positions], groupby_vars, group_numbers
+        )
+        n_groups = len(group_numbers)
+        match_counts = np.bincount(match_codes[match_codes >= 0], minlength=n_groups)
+        sample_sizes = frequency_sample_sizes(
+            np.bincount(case_codes[case_codes >= 0], minlength=n_groups),
+            match_counts,
+            len(cases),
+            len(positions),
+        )
+
+        ## Lay the matches out group by group and sample within each group
+        grouped = np.argsort(match_codes, kind="stable")
+        grouped = grouped[match_codes[grouped] >= 0]
+        sampled = grouped[sample_group_ordinals(match_counts, sample_sizes)]
+        matched_matches = matches.iloc[positions[np.sort(sampled)]]
+        return cases, matched_matches
+
+    ## Run either individual or frequency matching
+    if matching_type in STRATUM_MATCHERS:
+        cases, matched_cases, matched_matches = individual_matching(
+            cases, matches, indices, unavailable
+        )
+    elif matching_type == "frequency":
+        with telemetry.phase(
+            "matching", rows_in={"cases": len(cases), "matches": int(n_matches)}
+        ) as phase:
+            matched_cases, matched_matches = frequency_matching(
+                cases, matches, unavailable
+            )
+            phase["rows_out"] = {
+                "cases": len(matched_cases),
+                "matches": len(matched_matches),
+            }
+
+    ## Describe population differences
+    with telemetry.phase("comparison"):
+        scalar_comparisons = describe_balance(
+            report,
+            matched_cases,
+            matched_matches,
+            [
+                *match_variables,
+                *(closest_match_variables or []),
+                *(balance_variables or []),
+            ],
+        )
+
+    replacement_counts = []
+    if with_replacement:
+        uses = matched_matches.groupby(level=0)["match_uses"].first()
+        replacement_counts = [
+            f"Unique matches  {len(uses)}",
+            f"Matches used by more than one case  {(uses > 1).sum()}\n",
+        ]
+    report.add(
+        [
+            "After matching:",
+            f"Completed {datetime.now()}",
+            f"Cases    {len(matched_cases)}",
+            f"Matches  {len(matched_matches)}\n",
+            *replacement_counts,
+            "Number of available matches per case:",
+            # cases["match_counts"].value_counts().to_string(),
+        ]
+        + scalar_comparisons
+    )
+    return matched_cases, matched_matches, report
+
+
+def match(
+    case_csv: str,
+    match_csv: str,
+    matches_per_case: int,
+    match_variables: Dict,
+    index_date_variable: str,
+    matching_type: str = "individual",
+    closest_match_variables: Optional[List[Any]] = None,
+    date_exclusion_variables: Optional[Dict[Any, Any]] = None,
+    min_matches_per_case: int = 0,
+    replace_match_index_date_with_case: Optional[str] = None,
+    indicator_variable_name: str = "case",
+    output_suffix: str = "",
+    output_path: str = "tests/test_output",
+    input_path: str = "tests/test_data",
+    drop_cases_from_matches: bool = False,
+    workers: int = 1,
+    keep_columns: Optional[List[str]] = None,
+    chunksize: Optional[int] = None,
+    pool_cache_path: Optional[str] = None,
+    output_format: str = "csv",
+    output_tables: Tuple[str, ...] = ("combined", "membership"),
+    optimal_candidates_per_match: int = 5,
+    distance_metric: str = "euclidean",
+    distance_caliper: Optional[float] = None,
+    stream_matches: bool = False,
+    balance_variables: Optional[List[str]] = None,
+    with_replacement: bool = False,
+    checkpoint_path: Optional[str] = None,
+    checkpoint_seconds: float = 600,
+    match_index_date_range: Optional[Tuple[str, str]] = None,
+) -> None:
+    """
+    Wrapper function that calls functions to:
+    - import data
+    - match the cases to the matches with match_frames, which will
+      - find eligible matches
+      - pick the correct number of randomly allocated matches
+      - make exclusions that are based on index date
+        - (this is not currently possible in a study definition, and will only ever be possible
+          during matching for studies where the match index date comes from the case)
+      - set the set_id as that of the case_id (this excludes them from being matched later)
+        (unless with_replacement, when a match gets one row for each case that used
+        it, and match_uses records how many cases that was)
+      - set the index date of the match as that of the case (where desired)
+    - save the results as a csv
+
+    If checkpoint_path is given, individual matching saves its progress there
+    every checkpoint_seconds, and a rerun of the same match resumes from it. A
+    checkpoint is only resumed if the matching values, priorities, strata and
+    settings are all unchanged; otherwise matching starts again. Serial runs and
+    runs with workers can resume each other, except when matching with
+    replacement, where workers split strata into pieces. The checkpoint is
+    removed once matching completes.
+
+    If match_index_date_range (a start and end date) is given, the matches are
+    given index dates drawn uniformly from it rather than read from match_csv.
+    The dates of each chunksize (or STREAM_CHUNKSIZE) rows are drawn with their
+    own seed, so streamed and in-memory runs give the same dates.
+    """
+    check_match_settings(
+        matching_type, matches_per_case, min_matches_per_case, with_replacement
+    )
+    if stream_matches and matching_type != "frequency":
+        raise ValueError("stream_matches is only available for frequency matching")
+    if match_index_date_range is not None and pool_cache_path is not None:
+        raise ValueError("match_index_date_range cannot be used with pool_cache_path")
+
+    report = MatchingReport(
+        os.path.join(output_path, f"matching_report{output_suffix}.txt")
+    )
+    report.add([f"Matching started at: {datetime.now()}"])
+    telemetry = MatchingTelemetry(
+        os.path.join(output_path, f"matching_telemetry{output_suffix}.jsonl"),
+        matching_type=matching_type,
+        output_suffix=output_suffix,
+        workers=workers,
+    )
+    report.telemetry = telemetry.records
+
+    ## Deep copy match_variables
+    match_variables = copy.deepcopy(match_variables)
+
+    def write_balance() -> None:
+        os.makedirs(output_path, exist_ok=True)
+        report.balance.to_csv(
+            os.path.join(output_path, f"matching_balance{output_suffix}.csv"),
+            index=False,
+        )
+
+    def streamed_frequency_matching():
+        exclusion_vars = [*(date_exclusion_variables or {})]
+        with telemetry.phase("import") as phase:
+            cases = read_cohort_csv(
+                os.path.join(input_path, f"{case_csv}"),
+                match_variables,
+                [*exclusion_vars, index_date_variable],
+                keep_columns,
+                chunksize,
+            )
+            add_month_only_variables(cases, match_variables)
+            phase["rows_out"] = {"cases": len(cases)}
+        if replace_match_index_date_with_case is None:
+            exclusion_vars.append(index_date_variable)
+
+        def read_matches() -> Iterator[pd.DataFrame]:
+            for number, chunk in enumerate(
+                iter_cohort_csv(
+                    os.path.join(input_path, f"{match_csv}"),
+                    match_variables,
+                    exclusion_vars,
+                    keep_columns,
+                    chunksize or STREAM_CHUNKSIZE,
+                )
+            ):
+                ## Seeded by chunk number, so both passes see the same dates
+                if match_index_date_range is not None:
+                    assign_index_dates(
+                        chunk,
+                        index_date_variable,
+                        *match_index_date_range,
+                        seed=123 + number,
+                    )
+                add_month_only_variables(chunk, match_variables)
+                if drop_cases_from_matches:
+                    chunk = chunk.loc[~chunk.index.isin(cases.index)]
+                yield chunk
+
+        groupby_variables = copy.deepcopy(match_variables)
+        replace_month_only_variables(groupby_variables)
+        groupby_vars = [*groupby_variables.keys()]
+        with telemetry.phase("count_groups") as phase:
+            n_matches, match_chunks = stream_frequency_matches(
+                read_matches, cases, groupby_vars
+            )
+            phase["rows_out"] = {"matches": n_matches}
+        report.add(
+            [
+                "CSV import and match counts (streamed):",
+                f"Completed {datetime.now()}",
+                f"Cases    {len(cases)}",
+                f"Matches  {n_matches}",
+            ],
+        )
+
+        ## Keep just the balance variables of each chunk as it is written
+        balance_vars = [
+            *groupby_vars,
+            *(closest_match_variables or []),
+            *(balance_variables or []),
+        ]
+        match_summaries = []
+
+        def summarised(chunks: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+            for chunk in chunks:
+                match_summaries.append(
+                    chunk[[var for var in dict.fromkeys(balance_vars) if var in chunk]]
+                )
+                yield chunk
+
+        with telemetry.phase(
+            "sample_and_write", rows_in={"matches": n_matches}
+        ) as phase:
+            write_matched(
+                cases,
+                summarised(match_chunks),
+                output_path,
+                output_suffix,
+                output_format,
+                output_tables,
+            )
+            matched_matches = pd.concat(match_summaries)
+            phase["rows_out"] = {"cases": len(cases), "matches": len(matched_matches)}
+        replace_month_only_variables(match_variables)
+        with telemetry.phase("comparison"):
+            scalar_comparisons = describe_balance(
+                report, cases, matched_matches, balance_vars
+            )
+        write_balance()
+        report.add(
+            [
+                "After matching:",
+                f"Completed {datetime.now()}",
+                f"Cases    {len(cases)}",
+                f"Matches  {len(matched_matches)}\n",
+            ]
+            + scalar_comparisons
+        )
+
+    ## Import_data
+    if keep_columns is not None:
+        keep_columns = [
+            *(closest_match_variables or []),
+            *(balance_variables or []),
+            *keep_columns,
+        ]
+    if stream_matches:
+        streamed_frequency_matching()
+        return
+    with telemetry.phase("import", cached_pool=pool_cache_path is not None) as phase:
+        if pool_cache_path is None:
+            cases, matches = import_csvs(
+                case_csv,
+                match_csv,
+                match_variables,
+                date_exclusion_variables,
+                index_date_variable,
+                input_path,
+                replace_match_index_date_with_case,
+                keep_columns=keep_columns,
+                chunksize=chunksize,
+                match_index_date_range=match_index_date_range,
+            )
+            indices = None
+        else:
+            cases = read_cohort_csv(
+                os.path.join(input_path, f"{case_csv}"),
+                match_variables,
+                [*(date_exclusion_variables or {}), index_date_variable],
+                keep_columns,
+                chunksize,
+            )
+            add_month_only_variables(cases, match_variables)
+            matches, indices = get_match_pool(
+                match_csv,
+                match_variables,
+                date_exclusion_variables,
+                index_date_variable,
+                input_path,
+                replace_match_index_date_with_case,
+                keep_columns,
+                chunksize,
+                pool_cache_path,
+            )
+            replace_month_only_variables(match_variables)
+        phase["rows_out"] = {"cases": len(cases), "matches": len(matches)}
+
+    report.add(
+        [
+            "CSV import:",
+            f"Completed {datetime.now()}",
+            f"Cases    {len(cases)}",
+            f"Matches  {len(matches)}",
+        ],
+    )
+
+    matched_cases, matched_matches, report = match_frames(
+        cases,
+        matches,
+        matches_per_case,
+        match_variables,
+        index_date_variable,
+        matching_type=matching_type,
+        closest_match_variables=closest_match_variables,
+        date_exclusion_variables=date_exclusion_variables,
+        min_matches_per_case=min_matches_per_case,
+        replace_match_index_date_with_case=replace_match_index_date_with_case,
+        indicator_variable_name=indicator_variable_name,
+        drop_cases_from_matches=drop_cases_from_matches,
+        workers=workers,
+        optimal_candidates_per_match=optimal_candidates_per_match,
+        distance_metric=distance_metric,
+        distance_caliper=distance_caliper,
+        balance_variables=balance_variables,
+        with_replacement=with_replacement,
+        checkpoint_file=(
+            None
+            if checkpoint_path is None
+            else os.path.join(
+                checkpoint_path, f"matching_checkpoint{output_suffix}.npz"
+            )
+        ),
+        checkpoint_seconds=checkpoint_seconds,
+        report=report,
+        telemetry=telemetry,
+        indices=indices,
+    )
+    write_balance()
+
+    ## Write outputs
+    with telemetry.phase(
+        "write",
+        rows_in={"cases": len(matched_cases), "matches": len(matched_matches)},
+        output_format=output_format,
+        output_tables=output_tables,
+    ):
+        write_matched(
+            matched_cases,
+            matched_matches,
+            output_path,
+            output_suffix,
+            output_format,
+            output_tables,
+        )